@@ -0,0 +1,333 @@
+# RePixelator benchmark and accuracy suite
+# Runs the conversion over synthetic pixel art with known ground truth and saves the results as JSON.
+#
+#   python benchmarks/bench.py run [-o results.json] [--quick]
+#   python benchmarks/bench.py compare old.json new.json
+#   python benchmarks/bench.py imports [--budget ms]
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT)) # benchmark the working tree, not an installed copy
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+
+RESULTS_FORMAT = 1
+
+# default matrix, native width x scale x variant x mul
+SIZES = (32, 128, 320)
+SCALES = (3, 4.5, 8)
+VARIANTS = ('clean', 'offset', 'jpeg')
+MULS = ('1', '2', '4', 'auto')
+ANIM_FRAMES = 24
+
+QUICK_SIZES = (32, 128)
+QUICK_SCALES = (4, 6.5)
+
+# compare thresholds
+TIME_TOLERANCE = 0.15 # relative slowdown flagged as a regression
+TIME_FLOOR = 0.005 # seconds, slowdowns below this are noise
+ERROR_TOLERANCE = 0.5 # mean absolute pixel error increase
+
+# startup paths that must not load the heavy dependencies, each runs in a fresh interpreter
+IMPORT_CASES = {
+    'import repixelator': 'import repixelator; repixelator.__version__',
+    'repixelator --version': "import sys; sys.argv = ['repixelator', '--version']; from repixelator import cmd; cmd()",
+    'repixelator --help': "import sys; sys.argv = ['repixelator', '--help']; from repixelator import cmd; cmd()",
+    'repixelator client --help': "import sys; sys.argv = ['repixelator', 'client', '--help']; from repixelator import cmd; cmd()",
+}
+HEAVY_MODULES = ('cv2', 'numpy')
+IMPORT_BUDGET = 60.0 # ms over a bare interpreter start, OpenCV and numpy alone take about twice that
+
+
+def makeCases(sizes=SIZES, scales=SCALES, variants=VARIANTS, muls=MULS, animated=True) -> list:
+    cases = []
+    for size, scale, variant, mul in itertools.product(sizes, scales, variants, muls):
+        cases.append({
+            'name': f'{variant}-{size}-x{scale}-mul{mul}',
+            'kind': 'image',
+            'size': size,
+            'scale': scale,
+            'offset': 0.4 if variant == 'offset' else 0.0,
+            'jpeg': 85 if variant == 'jpeg' else None,
+            'mul': mul,
+        })
+    if animated:
+        for size, mul in itertools.product(sizes, muls):
+            cases.append({
+                'name': f'anim-{size}-x{scales[0]}-mul{mul}',
+                'kind': 'animation',
+                'size': size,
+                'scale': scales[0],
+                'offset': 0.0,
+                'jpeg': None,
+                'mul': mul,
+            })
+    return cases
+
+def runCase(case: dict, repeat=3, detector='projection', reduction='upscale') -> dict:
+    # runs in its own process, so the peak RSS belongs to this case only
+    import cv2
+    import synthetic
+    from repixelator.repixelator import rePixelateFile, detectGrid, applyGrid
+    
+    result = dict(case, detector=detector, reduction=reduction)
+    mul = case['mul'] if case['mul'] == 'auto' else int(case['mul'])
+    stages = {}
+    
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        stages.setdefault(stage, []).append(time.perf_counter() - start)
+        return ret
+    
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        if case['kind'] == 'animation':
+            in_file = os.path.join(tmp, 'anim.avi')
+            truth = synthetic.writeAnimation(in_file, case['size'], case['scale'], ANIM_FRAMES, case['offset'])
+            for _ in range(repeat):
+                report = {}
+                ok = timed('total', rePixelateFile, in_file, os.path.join(tmp, 'out.png'), mul, detector=detector, reduction=reduction, report=report)
+            result['frames'] = ANIM_FRAMES
+            out = cv2.imread(os.path.join(tmp, 'out_frame0001.png'))
+        
+        else:
+            img, truth = synthetic.makeCase(case['size'], case['scale'], case['offset'], case['jpeg'])
+            in_file = os.path.join(tmp, 'in.png')
+            cv2.imwrite(in_file, img)
+            for _ in range(repeat):
+                report = {}
+                start = time.perf_counter()
+                img = timed('read', cv2.imread, in_file, cv2.IMREAD_COLOR)
+                profile = timed('detect', detectGrid, img, mul, detector=detector, report=report, reduction=reduction)
+                ok, out = (False, None) if profile is None else timed('apply', applyGrid, img, profile, reduction=reduction, report=report)
+                if ok:
+                    timed('write', cv2.imwrite, os.path.join(tmp, 'out.png'), out)
+                stages.setdefault('total', []).append(time.perf_counter() - start)
+            result['frames'] = 1
+    
+    result['image'] = f"{img.shape[1]}x{img.shape[0]}" if case['kind'] == 'image' else None
+    result['ok'] = bool(ok)
+    result['seconds'] = {stage: statistics.median(times) for stage, times in stages.items()}
+    result['images_per_sec'] = result['frames'] / result['seconds']['total'] if result['seconds']['total'] else 0.0
+    result['stages'] = report.get('timings', {}) # inner stages of the last run
+    result['peak_buffer_mb'] = report.get('peak_buffer', 0) / 2**20
+    result['peak_rss_mb'] = peakRSS()
+    result['conv'] = [report.get('conv_x'), report.get('conv_y')]
+    result['truth'] = [round(truth['conv_x'], 3), round(truth['conv_y'], 3)]
+    result['mul_used'] = report.get('mul')
+    result['confidence'] = report.get('confidence')
+    result['grid_correct'] = bool(ok) and synthetic.gridCorrect(report.get('conv_x') or 0, report.get('conv_y') or 0, truth)
+    result['pixel_error'] = synthetic.pixelError(out, truth) if ok and out is not None else None
+    return result
+
+def peakRSS() -> float:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10 # bytes on macos, KiB elsewhere
+
+def _runCase(args):
+    return runCase(*args)
+
+def runAll(cases: list, repeat=3, detector='projection', reduction='upscale', verbose=True) -> list:
+    # one fresh process per case, maxtasksperchild keeps the RSS of earlier cases out
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(_runCase, [(case, repeat, detector, reduction) for case in cases]):
+            results.append(result)
+            if verbose:
+                print(f"{result['name']:<32} {result['seconds']['total']*1000:9.1f} ms {result['peak_rss_mb'] or 0:8.1f} MB  "
+                      f"grid {'ok ' if result['grid_correct'] else 'BAD'} {result['conv']} / {result['truth']}")
+    return results
+
+def summarize(results: list) -> dict:
+    total = sum(result['seconds']['total'] for result in results)
+    frames = sum(result['frames'] for result in results)
+    errors = [result['pixel_error'] for result in results if result['pixel_error'] is not None]
+    stages = {}
+    for result in results:
+        for stage, seconds in result['seconds'].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+    return {
+        'cases': len(results),
+        'failed': sum(not result['ok'] for result in results),
+        'grid_accuracy': sum(result['grid_correct'] for result in results) / len(results) if results else 0.0,
+        'exact_size': len(errors),
+        'mean_pixel_error': statistics.mean(errors) if errors else None,
+        'seconds': stages,
+        'images_per_sec': frames / total if total else 0.0,
+        'max_peak_rss_mb': max((result['peak_rss_mb'] or 0 for result in results), default=0),
+    }
+
+def environment() -> dict:
+    import cv2
+    import numpy as np
+    from repixelator.repixelator import __version__
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'repixelator': __version__,
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def compare(old: dict, new: dict, time_tolerance=TIME_TOLERANCE, error_tolerance=ERROR_TOLERANCE) -> list:
+    # returns the regressions of new against old, cases are matched by name
+    old_results = {result['name']: result for result in old['results']}
+    regressions = []
+    for result in new['results']:
+        base = old_results.get(result['name'])
+        if base is None:
+            continue
+        name = result['name']
+        
+        if base['ok'] and not result['ok']:
+            regressions.append(f'{name}: conversion fails')
+        if base['grid_correct'] and not result['grid_correct']:
+            regressions.append(f"{name}: grid {result['conv']} was {base['conv']}, truth {result['truth']}")
+        if base['pixel_error'] is not None:
+            if result['pixel_error'] is None:
+                regressions.append(f'{name}: output size no longer matches the truth')
+            elif result['pixel_error'] > base['pixel_error'] + error_tolerance:
+                regressions.append(f"{name}: pixel error {result['pixel_error']:.2f} was {base['pixel_error']:.2f}")
+        
+        for stage, seconds in result['seconds'].items():
+            before = base['seconds'].get(stage)
+            if before and seconds - before > TIME_FLOOR and seconds > before * (1 + time_tolerance):
+                regressions.append(f'{name}: {stage} {seconds*1000:.1f} ms was {before*1000:.1f} ms (+{(seconds/before-1)*100:.0f}%)')
+    
+    return regressions
+
+def importTimes(repeat=10) -> dict:
+    # median wall time of each startup case in ms, over the median start of a bare interpreter, and the heavy modules it loaded
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (str(ROOT), os.environ.get('PYTHONPATH')))))
+    
+    def run(statement: str) -> (float, list):
+        code = f'try:\n    {statement}\nexcept SystemExit:\n    pass\nimport sys\nprint(*[m for m in {HEAVY_MODULES!r} if m in sys.modules])'
+        times = []
+        for _ in range(repeat + 1): # the first run warms up the file cache
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+            times.append(time.perf_counter() - start)
+        return statistics.median(times[1:]) * 1000, out.splitlines()[-1].split() if out.strip() else []
+    
+    bare, _ = run('pass')
+    results = {'bare': bare}
+    for name, statement in IMPORT_CASES.items():
+        ms, modules = run(statement)
+        results[name] = {'ms': ms - bare, 'modules': modules}
+    return results
+
+def printSummary(summary: dict):
+    print(f"\n{summary['cases']} cases, {summary['failed']} failed")
+    print(f"Grid accuracy: {summary['grid_accuracy']*100:.1f}%")
+    if summary['mean_pixel_error'] is not None:
+        print(f"Mean pixel error: {summary['mean_pixel_error']:.3f} ({summary['exact_size']} cases with the exact size)")
+    print('Stage time: ' + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in summary['seconds'].items()))
+    print(f"Images/sec: {summary['images_per_sec']:.1f}")
+    print(f"Max peak RSS: {summary['max_peak_rss_mb']:.1f} MB")
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='RePixelator benchmark and accuracy suite.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    run = commands.add_parser('run', help='run the benchmark matrix')
+    run.add_argument('-o', '--output', help='save the results to this JSON file')
+    run.add_argument('--quick', action='store_true', help='smaller matrix')
+    run.add_argument('--sizes', type=int, nargs='+', help=f'native widths (default: {SIZES})')
+    run.add_argument('--scales', type=float, nargs='+', help=f'scale factors (default: {SCALES})')
+    run.add_argument('--variants', nargs='+', choices=VARIANTS, help='image variants (default: all)')
+    run.add_argument('--muls', nargs='+', help=f'pre zoom multipliers (default: {MULS})')
+    run.add_argument('--no-anim', action='store_true', help='skip the animated cases')
+    run.add_argument('--repeat', type=int, default=3, help='runs per case, the median is kept (default: %(default)s)')
+    run.add_argument('--detector', default='projection')
+    run.add_argument('--reduction', default='upscale')
+    
+    cmp = commands.add_parser('compare', help='flag regressions between two result files')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE, help='relative slowdown (default: %(default)s)')
+    cmp.add_argument('--error-tolerance', type=float, default=ERROR_TOLERANCE, help='pixel error increase (default: %(default)s)')
+    
+    imports = commands.add_parser('imports', help='time the startup paths, fail over the budget or when they load OpenCV or numpy')
+    imports.add_argument('--budget', type=float, default=IMPORT_BUDGET, help='ms over a bare interpreter start (default: %(default)s)')
+    imports.add_argument('--repeat', type=int, default=10, help='runs per case, the median is kept (default: %(default)s)')
+    return parser
+
+def main(args = sys.argv[1:]) -> int:
+    args = parser().parse_args(args)
+    
+    if args.command == 'compare':
+        with open(args.old, encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.new, encoding='utf-8') as f:
+            new = json.load(f)
+        print(f"{old['environment']['commit'] or args.old} -> {new['environment']['commit'] or args.new}")
+        printSummary(new['summary'])
+        regressions = compare(old, new, args.time_tolerance, args.error_tolerance)
+        print(f'\n{len(regressions)} regression(s)')
+        for regression in regressions:
+            print(regression)
+        return 1 if regressions else 0
+    
+    if args.command == 'imports':
+        results = importTimes(args.repeat)
+        print(f"Bare interpreter: {results.pop('bare'):.1f}ms")
+        failed = 0
+        for name, result in results.items():
+            over = result['ms'] > args.budget or result['modules']
+            failed += bool(over)
+            loaded = f", loads {' '.join(result['modules'])}" if result['modules'] else ''
+            print(f"{name:<28}{result['ms']:8.1f}ms{loaded}{'  FAIL' if over else ''}")
+        print(f'\n{failed} case(s) over the {args.budget:.0f}ms budget or loading the heavy modules')
+        return 1 if failed else 0
+    
+    scales = [int(scale) if scale == int(scale) else scale for scale in args.scales] if args.scales else None
+    cases = makeCases(args.sizes or (QUICK_SIZES if args.quick else SIZES),
+                      scales or (QUICK_SCALES if args.quick else SCALES),
+                      args.variants or VARIANTS, args.muls or MULS, not args.no_anim)
+    start = time.perf_counter()
+    results = runAll(cases, args.repeat, args.detector, args.reduction)
+    data = {
+        'format': RESULTS_FORMAT,
+        'environment': environment(),
+        'wall_seconds': time.perf_counter() - start,
+        'summary': summarize(results),
+        'results': results,
+    }
+    printSummary(data['summary'])
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+        print('Saved', args.output)
+    return 1 if data['summary']['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
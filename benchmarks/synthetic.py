@@ -0,0 +1,71 @@
+# Synthetic pixel art generator for the RePixelator benchmarks
+# Every image comes with its ground truth: the native image and the visible grid.
+
+import cv2
+import numpy as np
+
+
+def makePixelArt(width: int, height: int, colors=16, seed=0) -> np.ndarray:
+    # random palette blocks, with a few runs so the image isn't pure noise
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (colors, 3), dtype='uint8')
+    index = rng.integers(0, colors, (height, width))
+    runs = rng.random((height, width)) < 0.3
+    index[:, 1:][runs[:, 1:]] = index[:, :-1][runs[:, 1:]]
+    return palette[index]
+
+def enlarge(small: np.ndarray, scale: float, offset_x=0.0, offset_y=0.0, jpeg_quality=None) -> (np.ndarray, dict):
+    # nearest neighbor enlargement, the offsets crop the first pixels by that many enlarged pixels.
+    # returns the image and its ground truth.
+    nh, nw = small.shape[:2]
+    w, h = int((nw - 1) * scale - offset_x) + 1, int((nh - 1) * scale - offset_y) + 1
+    xs = np.floor((np.arange(w) + offset_x) / scale).astype('int64').clip(0, nw - 1)
+    ys = np.floor((np.arange(h) + offset_y) / scale).astype('int64').clip(0, nh - 1)
+    img = np.ascontiguousarray(small[ys][:, xs])
+    
+    if jpeg_quality:
+        img = cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])[1], cv2.IMREAD_COLOR)
+    
+    truth = {
+        'native': small[ys[0]:ys[-1]+1, xs[0]:xs[-1]+1], # pixels visible in the image
+        'conv_x': w / scale,
+        'conv_y': h / scale,
+        'scale': scale,
+    }
+    return img, truth
+
+def makeCase(size: int, scale: float, offset=0.0, jpeg_quality=None, seed=0) -> (np.ndarray, dict):
+    # size is the native width, landscape 4:3 like most screenshots
+    small = makePixelArt(size, max(size * 3 // 4, 4), seed=seed)
+    return enlarge(small, scale, offset * scale, offset * scale * 0.5, jpeg_quality)
+
+def writeAnimation(file: str, size: int, scale: float, frames=24, offset=0.0, seed=0) -> dict:
+    # moving sprite over a static background, returns the ground truth of the first frame
+    small = makePixelArt(size, max(size * 3 // 4, 4), seed=seed)
+    sprite = makePixelArt(max(size // 4, 2), max(size // 4, 2), seed=seed+1)
+    writer = None
+    
+    for i in range(frames):
+        frame = small.copy()
+        x = (i * max(size // frames, 1)) % max(size - sprite.shape[1], 1)
+        frame[:sprite.shape[0], x:x+sprite.shape[1]] = sprite[:, :frame.shape[1]-x]
+        
+        img, truth = enlarge(frame, scale, offset * scale, offset * scale * 0.5)
+        if writer is None:
+            first = truth
+            writer = cv2.VideoWriter(file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (img.shape[1], img.shape[0]))
+        writer.write(img)
+    
+    writer.release()
+    return first
+
+def gridCorrect(conv_x: int, conv_y: int, truth: dict) -> bool:
+    # cropped edge pixels may or may not be counted
+    return abs(conv_x - truth['conv_x']) <= 1 and abs(conv_y - truth['conv_y']) <= 1
+
+def pixelError(out: np.ndarray, truth: dict) -> float:
+    # mean absolute error against the visible native pixels, None if the sizes differ
+    native = truth['native']
+    if out.shape != native.shape:
+        return None
+    return float(np.mean(np.abs(out.astype('int16') - native)))
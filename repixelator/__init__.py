@@ -1,2 +1,25 @@
+# the API of repixelator.py is imported on first use, so the entry points and the version don't load OpenCV and numpy
+import importlib
+
+from ._version import __version__
 from .cmd import *
-from .repixelator import *
\ No newline at end of file
+
+__all__ = ['cmd', 'gui', '__version__', 'rePixelate', 'rePixelateFile', 'rePixelateBytes', 'rePixelateStack', 'detectGrid', 'detectGridFile',
+           'detectGridFrames', 'detectGridStack', 'detectTiles', 'applyGrid', 'setLogger', 'GridProfile', 'GridAccumulator', 'GridMap',
+           'GridPreview', 'Workspace', 'AnimationWriter', 'DETECTORS', 'REDUCTIONS', 'ANIMATIONS']
+
+
+def __getattr__(name):
+    if name.startswith('_'):
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    repixelator = importlib.import_module('.repixelator', __name__)
+    try:
+        value = getattr(repixelator, name)
+    except AttributeError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    globals()[name] = value
+    return value
+
+def __dir__():
+    repixelator = importlib.import_module('.repixelator', __name__)
+    return sorted(set(globals()) | {name for name in dir(repixelator) if not name.startswith('_')})
@@ -0,0 +1,2 @@
+# read by setup.py and the entry points without importing OpenCV
+__version__ = '1.0.0'
@@ -0,0 +1,182 @@
+# Asyncio API for RePixelator
+# Runs the conversions on an executor off the event loop, with a concurrency limit, timeouts and cancellation.
+# The messages of each conversion are collected into its result instead of being printed.
+#
+#   async with AsyncConverter(limit=4) as converter:
+#       result = await converter.convertBytes(data, '.png', mul=4, timeout=10)
+#       async for result in converter.convertFiles(files):
+#           print(result.input, result.ok)
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .repixelator import rePixelate, rePixelateFile, rePixelateBytes, _threadLogger
+
+
+class ConversionResult():
+    # ok: the conversion succeeded
+    # input, output: file paths, None for in-memory conversions
+    # data: converted image (np.ndarray) or encoded bytes (memoryview, bytes from process executors)
+    # report: the report dict of the conversion, with the total 'seconds'
+    # log: the messages of the conversion
+    # error: 'timeout' or the exception text when the conversion didn't finish
+    def __init__(self, ok: bool, input=None, output=None, data=None, report=None, log=None, error=None):
+        self.ok = ok
+        self.input = input
+        self.output = output
+        self.data = data
+        self.report = report or {}
+        self.log = log or []
+        self.error = error
+    
+    def toDict(self) -> dict:
+        # without the image data
+        return {'ok': self.ok, 'input': self.input, 'output': self.output, 'report': self.report, 'log': self.log, 'error': self.error}
+    
+    def __repr__(self):
+        return f'ConversionResult(ok={self.ok}, input={self.input!r}, output={self.output!r}, error={self.error!r})'
+
+
+class AsyncConverter():
+    # limit: conversions running at once (default: CPU count)
+    # executor: concurrent.futures executor, a thread pool of limit threads by default (OpenCV and numpy release the GIL).
+    #           a ProcessPoolExecutor also works, the results are then copied back as bytes.
+    def __init__(self, limit=None, executor=None):
+        self.limit = max(1, limit or os.cpu_count() or 1)
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(self.limit, thread_name_prefix='repixelator')
+        self.slots = {} # semaphore of each event loop, asyncio.run makes a new loop every time
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        # running conversions finish in the background, the queued ones are dropped
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    async def convertFile(self, in_file: str, out_file: str, timeout=None, **params) -> ConversionResult:
+        # params: keyword arguments of rePixelateFile
+        return await self._run('file', (str(in_file), str(out_file)), params, timeout)
+    
+    async def convertBytes(self, data, ext='.png', timeout=None, **params) -> ConversionResult:
+        # params: keyword arguments of rePixelateBytes, data is copied once for process executors
+        return await self._run('bytes', (data, ext), params, timeout)
+    
+    async def convertImage(self, img, timeout=None, **params) -> ConversionResult:
+        # params: keyword arguments of rePixelate
+        return await self._run('image', (img,), params, timeout)
+    
+    async def convertFiles(self, files, template='%s_converted.png', out_dir=None, outputs=None, timeout=None, **params):
+        # yields a ConversionResult for each file as it finishes, timeout applies to each file.
+        # only a few files per slot are submitted ahead, stopping the iteration cancels the rest.
+        files = [str(file) for file in files]
+        if outputs is None:
+            outputs = [str(Path(out_dir or Path(file).parent) / (template % Path(file).stem)) for file in files]
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        
+        pending = set()
+        jobs = iter(zip(files, outputs))
+        try:
+            while True:
+                for in_file, out_file in jobs:
+                    pending.add(asyncio.ensure_future(self.convertFile(in_file, out_file, timeout, **params)))
+                    if len(pending) >= self.limit * 2:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _run(self, kind: str, args: tuple, params: dict, timeout=None) -> ConversionResult:
+        loop = asyncio.get_running_loop()
+        slots = self.slots.get(loop)
+        if slots is None:
+            # the semaphores keep their loop alive, so the closed ones are dropped here
+            self.slots = {other: sem for other, sem in self.slots.items() if not other.is_closed()}
+            slots = self.slots[loop] = asyncio.Semaphore(self.limit)
+        
+        # the slot is held until the executor job really ends, a cancelled or timed out job can't be stopped once it runs
+        await slots.acquire()
+        try:
+            job = self.executor.submit(_convert, kind, args, params)
+        except BaseException:
+            slots.release()
+            raise
+        job.add_done_callback(lambda _: _release(loop, slots))
+        
+        names = (args[0], args[1]) if kind == 'file' else (None, None)
+        try:
+            ok, data, report, log = await asyncio.wait_for(asyncio.wrap_future(job), timeout)
+        except asyncio.TimeoutError:
+            return ConversionResult(False, *names, error='timeout')
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        except Exception as e: # worker process crashed
+            return ConversionResult(False, *names, error=str(e) or type(e).__name__)
+        return ConversionResult(ok, *names, data, report, log)
+
+
+_default = None
+
+def defaultConverter() -> AsyncConverter:
+    # shared converter of the module functions below
+    global _default
+    if _default is None:
+        _default = AsyncConverter()
+    return _default
+
+async def rePixelateFileAsync(in_file: str, out_file: str, timeout=None, **params) -> ConversionResult:
+    return await defaultConverter().convertFile(in_file, out_file, timeout, **params)
+
+async def rePixelateBytesAsync(data, ext='.png', timeout=None, **params) -> ConversionResult:
+    return await defaultConverter().convertBytes(data, ext, timeout, **params)
+
+async def rePixelateAsync(img, timeout=None, **params) -> ConversionResult:
+    return await defaultConverter().convertImage(img, timeout, **params)
+
+def convertFilesAsync(files, template='%s_converted.png', out_dir=None, outputs=None, timeout=None, **params):
+    # async iterator of ConversionResult, see AsyncConverter.convertFiles
+    return defaultConverter().convertFiles(files, template, out_dir, outputs, timeout, **params)
+
+def _release(loop, slots):
+    # from the executor thread, the loop may be gone by then
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        pass
+
+def _convert(kind: str, args: tuple, params: dict) -> (bool, object, dict, list):
+    # runs in the executor, the messages go to the result instead of the global logger
+    log = []
+    report = {}
+    data = None
+    start = time.perf_counter()
+    with _threadLogger(log.append):
+        try:
+            if kind == 'file':
+                ok = rePixelateFile(*args, report=report, **params)
+            elif kind == 'bytes':
+                ok, data = rePixelateBytes(*args, report=report, **params)
+                if multiprocessing.parent_process() is not None: # memoryviews can't leave a worker process
+                    data = data.tobytes()
+            else:
+                ok, data = rePixelate(*args, report=report, **params)
+        except Exception as e:
+            log.append(f'Unknown error: {e}')
+            ok = False
+    report['seconds'] = time.perf_counter() - start
+    return ok, data, report, log
@@ -0,0 +1,276 @@
+# Batch conversion for RePixelator
+# Converts many files, directories and glob patterns over a pool of worker processes.
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from .repixelator import rePixelateFile, GridProfile, Workspace, DETECTORS, REDUCTIONS, ANIMATIONS, VIDEO_EXTS, ANIMATED_EXTS, __version__
+from .cache import GridCache
+
+
+# extensions picked up when a directory is given, same as the GUI file dialog plus animations and raw arrays
+IMAGE_EXTS = ('.bmp', '.dib', '.jpeg', '.jpg', '.jpe', '.jp2', '.png', '.webp', '.pbm', '.pgm', '.ppm', '.pxm', '.pnm',
+              '.pfm', '.sr', '.ras', '.tiff', '.tif', '.exr', '.hdr', '.pic')
+FILE_EXTS = tuple(dict.fromkeys(IMAGE_EXTS + ANIMATED_EXTS + VIDEO_EXTS + ('.npy',)))
+
+PERCENTILES = (50, 90, 99) # of the stage timings in the summary
+
+_workspace = Workspace() # buffers reused by the conversions of this process
+
+
+def findFiles(inputs: list, recursive=False) -> list:
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = sorted(Path(item).glob('**/*' if recursive else '*'))
+            files += [str(path) for path in paths if path.is_file() and path.suffix.lower() in FILE_EXTS]
+        elif any(c in item for c in '*?['): # patterns aren't expanded by every shell
+            files += sorted(path for path in glob.glob(item, recursive=recursive) if os.path.isfile(path))
+        else:
+            files.append(item)
+    
+    return list(dict.fromkeys(files)) # remove duplicates, keep the order
+
+def outputPath(in_file: str, template='%s_converted.png', out_dir=None) -> str:
+    path = Path(in_file)
+    return str(Path(out_dir or path.parent) / (template % path.stem))
+
+def convertFiles(files: list, template='%s_converted.png', out_dir=None, params=None, jobs=None, cv_threads=None, verbose=True, json_out=None, outputs=None, on_done=None) -> dict:
+    # params: keyword arguments of rePixelateFile, including an optional GridCache
+    # json_out: stream that gets the report of each file as one JSON line, instead of printing the log
+    # outputs: output file of each input instead of the template, their directories must exist
+    # on_done: called with the index, the result and the report of each file as it finishes
+    params = params or {}
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(files) or 1))
+    if cv_threads is None and jobs > 1:
+        cv_threads = 1 # the workers already use every core
+    
+    if outputs is None:
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        outputs = [outputPath(file, template, out_dir) for file in files]
+    
+    failed_files = []
+    cache_hits = {'hit': 0, 'miss': 0}
+    detections = {'sampled': 0, 'full': 0} # path of the sampled detector
+    reports = []
+    count = 0
+    start = time.perf_counter()
+    
+    def done(i, ok, log, report=None):
+        nonlocal count
+        count += 1
+        if json_out is not None:
+            print(json.dumps({'file': files[i], 'output': outputs[i], 'ok': ok, 'report': report or {}}), file=json_out, flush=True)
+        elif verbose:
+            print(f'\nFile {count}/{len(files)}')
+            print(log, end='')
+        if not ok:
+            failed_files.append(files[i])
+        if report:
+            reports.append(report)
+            if 'cache' in report:
+                cache_hits[report['cache']] += 1
+            if 'detection' in report:
+                detections[report['detection']] += 1
+        if on_done is not None:
+            on_done(i, ok, report or {})
+    
+    if jobs == 1:
+        _initWorker(cv_threads)
+        for i, file in enumerate(files):
+            done(i, *_convertOne(file, outputs[i], params))
+    else:
+        with ProcessPoolExecutor(jobs, initializer=_initWorker, initargs=(cv_threads,)) as executor:
+            futures = {executor.submit(_convertOne, file, outputs[i], params): i for i, file in enumerate(files)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    done(i, *future.result())
+                except Exception as e: # worker crashed
+                    done(i, False, f'{files[i]}\nWorker error: {e}\n')
+    
+    elapsed = time.perf_counter() - start
+    lookups = cache_hits['hit'] + cache_hits['miss']
+    return {
+        'files': len(files),
+        'converted': len(files) - len(failed_files),
+        'failed': failed_files,
+        'seconds': elapsed,
+        'files_per_sec': len(files) / elapsed if elapsed > 0 else 0.0,
+        'jobs': jobs,
+        'cache_hits': cache_hits['hit'],
+        'cache_lookups': lookups,
+        'sampled_hits': detections['sampled'],
+        'sampled_detections': detections['sampled'] + detections['full'],
+        'timings': stageStats(reports),
+    }
+
+def stageStats(reports: list) -> dict:
+    # percentiles of the per file stage timings, in seconds
+    stages = {}
+    for report in reports:
+        for stage, seconds in report.get('timings', {}).items():
+            stages.setdefault(stage, []).append(seconds)
+    totals = [report['seconds'] for report in reports if 'seconds' in report]
+    if totals:
+        stages['total'] = totals
+    
+    stats = {}
+    for stage, values in stages.items():
+        stats[stage] = {f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+        stats[stage].update(count=len(values), sum=float(np.sum(values)))
+    return stats
+
+def printSummary(summary: dict, stats=False):
+    print(f"\nConverted {summary['converted']}/{summary['files']} files in {summary['seconds']:.2f}s "
+          f"({summary['files_per_sec']:.1f} files/s, {summary['jobs']} workers)")
+    if summary['cache_lookups']:
+        print(f"Cache: {summary['cache_hits']}/{summary['cache_lookups']} hits ({summary['cache_hits']/summary['cache_lookups']*100:.1f}%)")
+    if summary.get('sampled_detections'):
+        print(f"Sampled detection: {summary['sampled_hits']}/{summary['sampled_detections']} without the full pass "
+              f"({summary['sampled_hits']/summary['sampled_detections']*100:.1f}%)")
+    if stats and summary['timings']:
+        print(f"{'Stage (ms)':<12}" + ''.join(f'{f"p{p}":>10}' for p in PERCENTILES) + f"{'sum (s)':>10}")
+        for stage, stat in summary['timings'].items():
+            print(f'{stage:<12}' + ''.join(f"{stat[f'p{p}']*1000:10.2f}" for p in PERCENTILES) + f"{stat['sum']:10.2f}")
+    if summary['failed']:
+        print(f"{len(summary['failed'])} file(s) failed to process:")
+        for failed_file in summary['failed']:
+            print(failed_file)
+
+def _initWorker(cv_threads):
+    if cv_threads is not None:
+        import cv2
+        cv2.setNumThreads(cv_threads)
+
+def _convertOne(in_file: str, out_file: str, params: dict) -> (bool, str, dict):
+    # logs are collected per file, so the output of the workers doesn't interleave
+    log = io.StringIO()
+    report = {}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        try:
+            ok = rePixelateFile(in_file, out_file, report=report, workspace=_workspace, **params)
+        except Exception as e:
+            print('Unknown error:', e)
+            ok = False
+    report['seconds'] = time.perf_counter() - start
+    report['workspace_peak'] = _workspace.peak
+    return ok, log.getvalue(), report
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='repixelator batch', description='Convert many files at once.')
+    parser.add_argument('inputs', nargs='*', help='files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='%s_converted.png', help='output file name, %%s is the input file name (default: %(default)s)')
+    parser.add_argument('-d', '--out-dir', help="output directory (default: each file's directory)")
+    parser.add_argument('-r', '--recursive', action='store_true', help='search directories and ** patterns recursively')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes (default: CPU count)')
+    parser.add_argument('--cv-threads', type=int, help='OpenCV threads per worker (default: 1 with several workers)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    parser.add_argument('--json', action='store_true', help='print the report of each file and the summary as JSON lines')
+    parser.add_argument('--stats', action='store_true', help='print the stage timing percentiles in the summary')
+    addParamArguments(parser)
+    addCacheArguments(parser)
+    parser.add_argument('--clear-cache', action='store_true', help='empty the cache before converting')
+    return parser
+
+def addParamArguments(parser):
+    # conversion parameters, see fileParams
+    parser.add_argument('--mul', default='4', help="pre zoom multiplier or 'auto' (default: %(default)s)")
+    parser.add_argument('--nr-sigma', default='0.0', help='noise reduction sigma (default: %(default)s)')
+    parser.add_argument('--edge-threshold', default='1.0', help='edge pixel threshold (default: %(default)s)')
+    parser.add_argument('--detector', default='projection', choices=DETECTORS)
+    parser.add_argument('--reduction', default='upscale', choices=REDUCTIONS)
+    parser.add_argument('--band', default='0', help='stream images in bands of this many rows (default: off)')
+    parser.add_argument('--profile', help='apply this grid profile to every file instead of detecting (see the detect command)')
+    parser.add_argument('--animation', default='auto', choices=ANIMATIONS, help="animation output, one 'container' file or numbered 'frames' (default: container for video extensions)")
+    parser.add_argument('--analysis-frames', default='1', help='detect the grid of animations on up to this many frames, stops early once stable (default: %(default)s)')
+    parser.add_argument('--analysis-step', default='1', help='analyze every n-th frame of animations (default: %(default)s)')
+    parser.add_argument('--video-workers', default='1', help='processes converting chunks of each video, for long videos and few files (default: %(default)s)')
+    parser.add_argument('--queue-depth', default='8', help='frames in flight when decoding, converting and encoding animations at once, 0 converts them one by one (default: %(default)s)')
+
+def addCacheArguments(parser):
+    parser.add_argument('--cache', action='store_true', help='reuse detected grids from the on-disk cache (default: on if REPIXELATOR_CACHE is set)')
+    parser.add_argument('--no-cache', action='store_true', help='disable the cache')
+    parser.add_argument('--cache-dir', help='cache directory (default: REPIXELATOR_CACHE or the user cache directory)')
+    parser.add_argument('--cache-size', type=int, default=100000, help='maximum number of cached grids (default: %(default)s)')
+
+def gridCache(args) -> GridCache:
+    # REPIXELATOR_CACHE turns the cache on by default, its value is the directory or 1
+    env = os.environ.get('REPIXELATOR_CACHE', '')
+    if args.no_cache or not (args.cache or args.cache_dir or env or args.clear_cache):
+        return None
+    path = args.cache_dir or (env if env not in ('', '1') else None)
+    return GridCache(path, args.cache_size)
+
+def fileParams(args) -> dict:
+    return {
+        'mul': args.mul,
+        'nr_sigma': args.nr_sigma,
+        'edge_threshold': args.edge_threshold,
+        'detector': args.detector,
+        'reduction': args.reduction,
+        'band': args.band,
+        'animation': args.animation,
+        'analysis_frames': args.analysis_frames,
+        'analysis_step': args.analysis_step,
+        'workers': args.video_workers,
+        'queue_depth': args.queue_depth,
+    }
+
+def main(args = sys.argv[1:]) -> int:
+    args = parser().parse_args(args)
+    if args.json: # stdout only carries the JSON lines
+        json_out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            return _run(args, json_out)
+    return _run(args)
+
+def _run(args, json_out=None) -> int:
+    print('RePixelator', __version__, 'batch')
+    
+    try:
+        str(Path(args.output).stem) % ''
+    except:
+        print('Invalid output file name')
+        return 2
+    
+    cache = gridCache(args)
+    if args.clear_cache and cache is not None:
+        print(cache.clear(), 'cached grids removed')
+        if not args.inputs:
+            return 0
+    
+    files = findFiles(args.inputs, args.recursive)
+    if not files:
+        print('No input files')
+        return 2
+    
+    params = fileParams(args)
+    params['cache'] = cache
+    if args.profile:
+        try:
+            params['profile'] = GridProfile.load(args.profile)
+        except:
+            print('Profile read error.')
+            return 2
+    summary = convertFiles(files, args.output, args.out_dir, params, args.jobs, args.cv_threads, not args.quiet, json_out)
+    printSummary(summary, args.stats)
+    if json_out is not None:
+        print(json.dumps({'summary': summary}), file=json_out)
+    
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# Grid detection cache for RePixelator
+# Stores the detected grid of each image on disk, keyed by a hash of the decoded pixels and the detection parameters.
+# Entries are small JSON files written atomically, so one cache directory can be shared by concurrent workers.
+
+import hashlib
+import json
+import os
+import random
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+
+CACHE_FORMAT = 3 # bump when the detection changes, old entries are ignored
+HASH_ROWS = 256 # rows hashed at a time, keeps memory mapped inputs streaming
+
+
+def defaultCacheDir() -> str:
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else os.environ.get('XDG_CACHE_HOME')
+    return str(Path(base or Path.home() / '.cache') / 'repixelator')
+
+
+class GridCache():
+    def __init__(self, path=None, max_entries=100000):
+        self.path = Path(path or defaultCacheDir())
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+    
+    def key(self, img: np.ndarray, mul, nr_sigma, detector, reduction='upscale', band=0) -> str:
+        # mul='auto' picks the pre zoom for the reduction and band streaming, the fixed muls don't depend on them
+        params = f'{mul}|{float(nr_sigma)}|{detector}' + (f'|{reduction}|{bool(band)}' if mul == 'auto' else '')
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'{CACHE_FORMAT}|{img.shape}|{img.dtype}|{params}'.encode())
+        for y in range(0, img.shape[0], HASH_ROWS):
+            h.update(np.ascontiguousarray(img[y:y+HASH_ROWS]).data)
+        return h.hexdigest()
+    
+    def get(self, key: str) -> dict:
+        file = self._file(key)
+        try:
+            with open(file, encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(file) # mtime is the LRU clock
+        except (OSError, ValueError): # missing, evicted meanwhile or half written by a crashed worker
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        return entry
+    
+    def put(self, key: str, entry: dict):
+        file = self._file(key)
+        tmp = file.with_name(f'{file.name}.{uuid.uuid4().hex}.tmp')
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, file) # atomic, readers never see partial entries
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        
+        # check the size once in about max_entries/100 puts. workers get their own copy of the cache,
+        # so a counter would start over with every job, a random check doesn't depend on this instance
+        if random.random() * max(self.max_entries // 100, 1) < 1:
+            self.evict()
+    
+    def evict(self) -> int:
+        # remove the least recently used entries above max_entries
+        entries = []
+        for file in self._files():
+            try:
+                entries.append((file.stat().st_mtime, file))
+            except OSError:
+                pass
+        
+        removed = 0
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for _, file in entries[:len(entries)-self.max_entries]:
+                try:
+                    os.remove(file)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+    
+    def clear(self) -> int:
+        removed = 0
+        for file in self._files():
+            try:
+                os.remove(file)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+    
+    def size(self) -> int:
+        return sum(1 for _ in self._files())
+    
+    def hitRate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / (key + '.json')
+    
+    def _files(self):
+        if self.path.is_dir():
+            yield from self.path.glob('*/*.json')
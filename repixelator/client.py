@@ -0,0 +1,102 @@
+# Client of the RePixelator conversion server (repixelator serve)
+# Only uses the standard library, so it starts quickly from shell scripts.
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from urllib.parse import urlencode
+
+
+DEFAULT_URL = 'http://127.0.0.1:8617'
+
+
+def request(url: str, data=None, headers={}, timeout=None) -> (int, dict, bytes):
+    # returns the status code, the headers and the body, also for HTTP errors
+    import urllib.error, urllib.request # http.client costs more than the rest of the client, --help doesn't need it
+    req = urllib.request.Request(url, data, headers)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return res.status, dict(res.headers), res.read()
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), e.read()
+
+def convertFile(url: str, in_file: str, out_file: str, params: dict, timeout=None) -> (int, dict):
+    # the server reads and writes the files, paths are sent as absolute paths
+    job = dict(params, in_file=os.path.abspath(in_file), out_file=os.path.abspath(out_file))
+    status, _, body = request(url + '/convert', json.dumps(job).encode(), {'Content-Type': 'application/json'}, timeout)
+    return status, json.loads(body)
+
+def convertBytes(url: str, data: bytes, params: dict, ext='.png', timeout=None) -> (int, dict, bytes):
+    # returns the converted image bytes, or b'' if the conversion failed
+    query = urlencode(dict(params, format=ext))
+    status, headers, body = request(f'{url}/convert?{query}', data, {'Content-Type': 'application/octet-stream'}, timeout)
+    if status != 200:
+        return status, json.loads(body), b''
+    return status, {'ok': True, 'report': json.loads(headers.get('X-RePixelator-Report', '{}'))}, body
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='repixelator client', description='Convert a file with a running repixelator server.')
+    parser.add_argument('in_file', nargs='?', help="input file, - for stdin with --upload")
+    parser.add_argument('out_file', nargs='?', help="output file, - for stdout with --upload")
+    parser.add_argument('--url', default=os.environ.get('REPIXELATOR_SERVER', DEFAULT_URL), help='server address (default: REPIXELATOR_SERVER or %(default)s)')
+    parser.add_argument('--upload', action='store_true', help="send the image bytes instead of the paths, for servers that can't see the files")
+    parser.add_argument('--health', action='store_true', help='print the server status')
+    parser.add_argument('--stats', action='store_true', help='print the server statistics')
+    parser.add_argument('--json', action='store_true', help='print the server response as JSON')
+    parser.add_argument('--timeout', type=float, help='seconds to wait for the server')
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't print the conversion log")
+    for param in ('mul', 'nr-sigma', 'edge-threshold', 'detector', 'reduction', 'band', 'profile', 'animation', 'analysis-frames', 'analysis-step'):
+        parser.add_argument('--' + param)
+    return parser
+
+def main(args = sys.argv[1:]) -> int:
+    # exit code 0 on success, 1 if the conversion failed, 2 on usage or connection errors, 3 if the server is busy
+    args = parser().parse_args(args)
+    url = args.url.rstrip('/')
+    
+    try:
+        if args.health or args.stats:
+            status, _, body = request(url + ('/health' if args.health else '/stats'), timeout=args.timeout)
+            print(json.dumps(json.loads(body), indent=4))
+            return 0 if status == 200 else 2
+        
+        if not args.in_file or not args.out_file:
+            print('Input and output files are needed', file=sys.stderr)
+            return 2
+        params = {key: value for key, value in vars(args).items()
+                  if key in ('mul', 'nr_sigma', 'edge_threshold', 'detector', 'reduction', 'band', 'profile', 'animation', 'analysis_frames', 'analysis_step') and value is not None}
+        
+        if args.upload:
+            data = sys.stdin.buffer.read() if args.in_file == '-' else Path(args.in_file).read_bytes()
+            ext = '.png' if args.out_file == '-' else os.path.splitext(args.out_file)[1]
+            status, result, out = convertBytes(url, data, params, ext, args.timeout)
+            if out:
+                if args.out_file == '-':
+                    sys.stdout.buffer.write(out)
+                else:
+                    Path(args.out_file).write_bytes(out)
+        else:
+            status, result = convertFile(url, args.in_file, args.out_file, params, args.timeout)
+    except (OSError, ValueError) as e: # connection refused, timeout or unreadable file
+        print('Server error:', e, file=sys.stderr)
+        return 2
+    
+    # stdout may carry the image, the rest goes to stderr then
+    out = sys.stderr if args.upload and args.out_file == '-' else sys.stdout
+    if args.json:
+        print(json.dumps(result), file=out)
+    elif not args.quiet and 'log' in result:
+        print(result['log'], end='', file=out)
+    
+    if status == 503:
+        print('Server busy, try again later', file=sys.stderr)
+        return 3
+    if 'error' in result:
+        print('Server error:', result['error'], file=sys.stderr)
+        return 2
+    return 0 if result.get('ok') else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,40 @@
+import importlib
 import sys
 
+__all__ = ['cmd', 'gui']
+
+# subcommand -> module, imported when used, so the client, --help and --version don't load OpenCV
+COMMANDS = {'batch': 'batch', 'serve': 'server', 'client': 'client', 'sync': 'sync'}
+
+USAGE = '''Usage: [--json] in_file out_file [nZoom [fNoise [fEdge_thr [detector [reduction [nBand]]]]]]
+       [--json] detect in_file profile_file [nZoom [fNoise [detector [reduction]]]]
+       [--json] apply in_file out_file profile_file [fEdge_thr [reduction]]
+       batch [options] inputs... (see batch --help)
+       sync [options] in_dir out_dir (see sync --help)
+       serve [options] / client [options] in_file out_file (see serve --help, client --help)
+Example: in.png out.png 4 0 0.8
+'''
+
 def cmd():
     args = sys.argv[1:]
+    if args and args[0] in ('-V', '--version'):
+        from ._version import __version__
+        print('RePixelator', __version__)
+        sys.exit(0)
+    if args and args[0] in ('-h', '--help'):
+        from ._version import __version__
+        print('RePixelator', __version__, 'by yclee126')
+        print(USAGE)
+        sys.exit(0)
+    if args and args[0] in COMMANDS:
+        sys.exit(subcommand(args[0]).main(args[1:]))
+    
     from .repixelator import main
-    main(args)
+    sys.exit(main(args))
 
 def gui():
     from .repixelator_gui import main
-    main()
\ No newline at end of file
+    main()
+
+def subcommand(name: str):
+    return importlib.import_module('.' + COMMANDS[name], __package__)
@@ -1,198 +1,1781 @@
 # RePixelator v1.0.0 by yclee126
-# Works on Python 3.5 or higher
+# Works on Python 3.9 or higher
 #
 # This program converts enlarged pixel arts into their original resolution through FFT analysis.
 
-__version__ = '1.0.0'
-
 import cv2
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hashlib
+import io
+import json
+import os
+import queue
 import sys
+import threading
+import time
+import contextlib
 
+try:
+    from ._version import __version__
+    from .cmd import COMMANDS, USAGE, subcommand
+except ImportError: # run as a script
+    from _version import __version__
+    from cmd import COMMANDS, USAGE, subcommand
 
-def rePixelateFile(in_file: str, out_file: str, mul='4', nr_sigma='0.0', edge_threshold='1.0') -> bool:
-    print(in_file)
-    
-    animation = False
+
+# Grid detection engines.
+# 'projection' works on the 1D edge projections of the original resolution image and is the default.
+# 'upscale' is the original engine that pre zooms the whole image by mul before the analysis.
+# Both return the same FFT size except where the upscale engine locks onto a harmonic at low mul,
+# and the offsets agree within 0.2px of the original image (modulo the pixel size).
+# 'tiles' runs the projection detector on overlapping tiles and takes the grid most tiles vote for,
+# for screenshots that mix pixel art with UI at another scale. See detectTiles.
+# 'sampled' runs the projection detector on a few evenly spaced rows and columns and falls back to the full pass
+# when the two interleaved halves of the lines don't find the same FFT size. report['detection'] tells which path was taken.
+DETECTORS = ('projection', 'upscale', 'tiles', 'sampled')
+
+SAMPLED_LINES = 32 # rows and columns of the sampled detector
+
+FFT_PAD = 8 # zero padding factor of the projection spectrum, used for the peak refinement
+
+# Reconstruction modes.
+# 'upscale' pads, offsets and shrinks the pre zoomed image with INTER_AREA, which is the original method.
+# The others map the grid straight onto the original image and reduce each cell to one pixel:
+# 'mean' averages the pixels fully inside the cell, 'center' takes the center pixel,
+# 'median' and 'mode' look at samples of the pixels fully inside the cell.
+# 'center' and 'mode' keep the exact palette of the image.
+REDUCTIONS = ('upscale', 'mean', 'center', 'median', 'mode')
+
+MAX_CONFIDENCE = 100.0 # FFT peak to strongest non harmonic peak ratio is capped to this value
+
+# mul='auto' tries these multipliers in order and stops at the first confident detection.
+# The 'upscale' reconstruction also needs pre zoomed pixels of at least AUTO_PIXSIZE.
+# Without noise reduction the projection detectors find the same grid at every mul, so they detect once
+# and only pick mul by the pixel size. nr_sigma is given in pre zoomed pixels, so it still needs the cascade.
+AUTO_MULS = (1, 2, 4)
+AUTO_CONFIDENCE = 1.15
+AUTO_PIXSIZE = 5
+
+BAND_ROWS = 256 # default band height for streaming .npy inputs
+
+VIDEO_EXTS = ('.mp4', '.avi', '.webm', '.mkv', '.mov', '.m4v', '.wmv') # opened with the capture without trying the image decoder
+ANIMATED_EXTS = ('.gif', '.webp', '.png', '.apng', '.avif') # read frame by frame when they hold more than one frame
+
+# Animation outputs.
+# 'frames' writes every frame as a numbered image file, which is the original method.
+# 'container' writes one video (VIDEO_EXTS) or animated image (.gif, .webp, .png, .avif) file.
+# 'auto' is 'container' for video extensions and 'frames' otherwise.
+ANIMATIONS = ('auto', 'frames', 'container')
+VIDEO_CODECS = {'.mp4': 'mp4v', '.m4v': 'mp4v', '.mov': 'mp4v', '.avi': 'FFV1', '.mkv': 'FFV1', '.webm': 'VP80', '.wmv': 'WMV2'}
+DEFAULT_FPS = 10 # when the input doesn't tell
+ANIMATION_CHUNKS = 4 # chunks per worker process when converting a video in parallel, evens out the load
+ANIMATION_CHUNK_FRAMES = 256 # at most, only workers+1 chunks of converted frames are held at a time
+
+# Multi-frame grid detection of animations, see detectGridFrames.
+# The analysis stops when the FFT size stays the same for ANALYSIS_STABLE frames with at least AUTO_CONFIDENCE.
+ANALYSIS_STABLE = 3
+
+# Tiled grid analysis, see detectTiles.
+# Tiles of the same grid vote together when their pixel sizes differ by less than TILE_TOLERANCE.
+TILE_SIZE = 256
+TILE_OVERLAP = 0.5
+TILE_TOLERANCE = 0.02
+
+WORKSPACE_LIMIT = 1 << 29 # bytes a Workspace keeps at most, see Workspace
+
+STACK_PIXELS = 1 << 24 # image stacks are analyzed in chunks of about this many pixels, see detectGridStack
+
+PROFILE_VERSION = 1 # grid profile file format
+
+# Diagnostics go through this function, one message per call. See setLogger.
+_logger = print
+_local = threading.local() # per thread logger, see _threadLogger
+
+def setLogger(logger=None):
+    # logger: function taking one message string, None restores print
+    global _logger
+    _logger = logger or print
+
+@contextlib.contextmanager
+def _threadLogger(logger):
+    # sends the messages of the current thread to logger instead, so concurrent conversions keep their logs apart
+    previous = getattr(_local, 'logger', None)
+    _local.logger = logger
     try:
-        img = cv2.imdecode(np.fromfile(in_file, dtype='uint8'), cv2.IMREAD_COLOR) # non-ASCII path workaround
-        img.shape
-    except:
+        yield
+    finally:
+        _local.logger = previous
+
+def rePixelateFile(in_file: str, out_file: str, mul='4', nr_sigma='0.0', edge_threshold='1.0', detector='projection', reduction='upscale', band='0', report=None, cache=None, profile=None, encode_params=None, animation='auto', analysis_frames='1', analysis_step='1', workers='1', queue_depth='8', workspace=None) -> bool:
+    # profile: GridProfile or profile file to use instead of the detection
+    # encode_params: OpenCV imwrite flags of the output format, ex) [cv2.IMWRITE_PNG_COMPRESSION, 9]
+    # animation: output of animated inputs, see ANIMATIONS
+    # analysis_frames, analysis_step: detect the grid of animations on up to this many frames, taking every step-th frame
+    # workers: processes converting chunks of videos that can seek, other animations are converted by the pipeline below
+    # queue_depth: decoded and converted frames in flight in the pipeline of the other animations, 0 converts them one by one
+    # workspace: optional Workspace reused by still images and the frames converted one by one
+    _log(in_file)
+    
+    band = int(band)
+    mul = mul if mul == 'auto' else int(mul)
+    if isinstance(profile, (str, Path)):
         try:
-            cap = cv2.VideoCapture(in_file)
-            if cap is None or not cap.isOpened():
-                raise ValueError
-            animation = True
+            profile = GridProfile.load(profile)
         except:
-            print('File read error or non-ASCII path error for animated images.')
+            _log('Profile read error.')
             return False
     
-    if not animation:
-        ret, img = rePixelate(img, int(mul), float(nr_sigma), float(edge_threshold))
+    # still images are converted in memory, animations are read frame by frame below
+    suffix = Path(in_file).suffix.lower()
+    try:
+        with _timed(report, 'decode'):
+            if suffix == '.npy':
+                data = np.load(in_file, mmap_mode='r')
+                band = band or BAND_ROWS # raw arrays are memory mapped and streamed in bands
+            else:
+                data = None if _isAnimation(in_file) else np.fromfile(in_file, dtype='uint8') # non-ASCII path workaround
+    except:
+        data = None
+    
+    if data is not None:
+        params = (mul, float(nr_sigma), float(edge_threshold), detector, reduction, report, band, cache, profile, workspace)
+        ret, out = _rePixelateBuffer(data, str(Path(out_file).suffix), encode_params, params)
+    
+    if data is not None and ret is not None:
         if not ret:
             return False
         
         try:
-            ext = str(Path(out_file).suffix)
-            cv2.imencode(ext, img)[1].tofile(out_file)
+            with _timed(report, 'encode'):
+                with open(out_file, 'wb') as f:
+                    f.write(out)
             return True
         except:
-            print('File write error.\nCheck for write permission or output file extension.')
+            _log('File write error.\nCheck for write permission or output file extension.')
             return False
     
-    else: # this also includes static .gif files which can't be rewinded
-        _, img = cap.read()
-        _, img_conv = rePixelate(img, int(mul), float(nr_sigma), 0)
-        h, w, _ = img_conv.shape
+    else: # this also includes images the decoder can't read, such as GIFs on older OpenCV
+        cap = _openCapture(in_file)
+        if cap is None:
+            return False
+        
+        with _timed(report, 'decode'):
+            ret, img = cap.read()
+        if not ret:
+            cap.release()
+            _log('File read error or non-ASCII path error for animated images.')
+            return False
+        h, w = img.shape[:2]
+        _log(f'Image: {w}x{h}')
+        if report is not None:
+            report['image'] = [w, h]
+        
+        # the grid of the first frames is applied to every frame
+        if profile is None and int(analysis_frames) > 1:
+            profile = detectGridFrames(_captureFrames(cap, img, int(analysis_step), report), mul, float(nr_sigma), detector, int(analysis_frames), report, reduction)
+            
+            # back to the first frame
+            cap.release()
+            cap = _openCapture(in_file)
+            if cap is None:
+                return False
+            with _timed(report, 'decode'):
+                ret, img = cap.read()
+            if not ret:
+                cap.release()
+                _log('File read error.')
+                return False
+            
+        elif profile is None:
+            profile = detectGrid(img, mul, float(nr_sigma), detector, cache=cache, report=report, reduction=reduction, workspace=workspace)
+        ret, dirs = _gridEdges(img, profile, float(edge_threshold), reduction, report)
+        if not ret:
+            cap.release()
+            return False
+        
+        if animation not in ANIMATIONS:
+            cap.release()
+            _log('Unknown animation output:', animation)
+            return False
+        writer = AnimationWriter(out_file, animation, cap.get(cv2.CAP_PROP_FPS), encode_params)
+        if not writer.supported():
+            cap.release()
+            _log(f'Animated {writer.ext} output needs OpenCV 4.12 or higher, write the frames or a video instead')
+            return False
+        
+        frame_count = _seekableFrames(in_file) if int(workers) > 1 else 0
+        if frame_count:
+            cap.release()
+            try:
+                i = _convertChunks(in_file, frame_count, profile, dirs, reduction, writer, int(workers), report)
+            except IOError:
+                _log('File write error.\nCheck for write permission or output file extension.')
+                return False
+            except Exception as e: # worker crashed
+                _log('Worker error:', e)
+                return False
+            return _closeAnimation(writer, i, report)
+        elif int(workers) > 1:
+            _log('Sequential conversion, the input can\'t seek')
+        
+        if int(queue_depth) > 0:
+            try:
+                i = _convertPipeline(cap, img, profile, dirs, reduction, writer, int(queue_depth), report)
+            except IOError:
+                _log('File write error.\nCheck for write permission or output file extension.')
+                return False
+            finally:
+                cap.release()
+            return _closeAnimation(writer, i, report)
         
         i = 0
         while True:
-            img = cv2.resize(img, (w, h), cv2.INTER_AREA)
-            path = str(Path(out_file).parent / Path(out_file).stem) + f'_frame{i+1:04d}' + str(Path(out_file).suffix)
+            img = _reconstruct(img, profile, dirs, reduction, report=report, workspace=workspace)
             try:
-                cv2.imwrite(path, img)
+                with _timed(report, 'encode'):
+                    writer.write(img)
             except:
-                print('File write error.\nCheck for write permission or output file extension.')
+                cap.release()
+                _log('File write error.\nCheck for write permission or output file extension.')
                 return False
             
             i += 1
-            ret, img = cap.read()
+            with _timed(report, 'decode'):
+                ret, img = cap.read()
             if not ret:
                 cap.release()
-                print(i, 'frames converted')
-                return True
+                return _closeAnimation(writer, i, report)
 
-def rePixelate(img: np.ndarray, mul=4, nr_sigma=0.0, edge_threshold=1.0) -> (bool, np.ndarray):
-    h, w, c = img.shape
-    print(f'Image: {w}x{h}')
+def _closeAnimation(writer, frames: int, report=None) -> bool:
+    try:
+        with _timed(report, 'encode'):
+            writer.close()
+    except:
+        _log('File write error.\nCheck for write permission or output file extension.')
+        return False
     
-    img = cv2.resize(img, None, fx=mul, fy=mul, interpolation=cv2.INTER_LINEAR)
-    h, w, c = img.shape
+    _log(frames, 'frames converted')
+    if writer.duplicates:
+        _log(writer.duplicates, 'duplicate frames merged')
+    if report is not None:
+        report.update(frames=frames, written=writer.written, duplicates=writer.duplicates)
+    return True
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    if nr_sigma > 0:
-        gray = cv2.GaussianBlur(gray, (0, 0), nr_sigma, borderType=cv2.BORDER_REPLICATE)
+def _seekableFrames(in_file: str) -> int:
+    # frame count of videos that seek to exact frames, 0 for the others (GIFs, unknown lengths)
+    if Path(in_file).suffix.lower() not in VIDEO_EXTS:
+        return 0
+    cap = _openCapture(in_file)
+    if cap is None:
+        return 0
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    probe = count // 2
+    seekable = count > 1 and cap.set(cv2.CAP_PROP_POS_FRAMES, probe) and int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == probe
+    cap.release()
+    return count if seekable else 0
+
+def _convertChunks(in_file: str, frame_count: int, profile, dirs, reduction, writer, workers: int, report=None) -> int:
+    # converts chunks of frames in worker processes and writes them in order, returns the number of frames.
+    # the frame count may be off, the last chunk reads until the end.
+    # one chunk more than the workers is in flight, so the workers stay busy while the finished chunk is written.
+    size = min(-(-frame_count // (workers * ANIMATION_CHUNKS)), ANIMATION_CHUNK_FRAMES)
+    starts = list(range(0, frame_count, size))
+    chunks = []
+    frames = 0
+    with ProcessPoolExecutor(min(workers, len(starts))) as executor:
+        def submit(k):
+            return executor.submit(_convertChunk, in_file, starts[k], size if k < len(starts) - 1 else None, profile, dirs, reduction)
+        
+        futures = {k: submit(k) for k in range(min(workers + 1, len(starts)))}
+        for k in range(len(starts)):
+            imgs, timings, seconds = futures.pop(k).result()
+            if k + workers + 1 < len(starts):
+                futures[k + workers + 1] = submit(k + workers + 1)
+            with _timed(report, 'encode'):
+                for img in imgs:
+                    writer.write(img)
+            frames += len(imgs)
+            
+            _log(f'Chunk {k+1}/{len(starts)}: {len(imgs)} frames, {len(imgs) / seconds if seconds else 0.0:.1f} frames/s')
+            chunks.append({'start': starts[k], 'frames': len(imgs), 'seconds': seconds})
+            _addTimings(report, timings)
+    
+    if report is not None:
+        report['chunks'] = chunks
+    return frames
+
+def _convertChunk(in_file: str, start: int, count, profile, dirs, reduction) -> (list, dict, float):
+    # runs in a worker process, count None reads until the end
+    cv2.setNumThreads(1) # the other workers use the other cores
+    begin = time.perf_counter()
+    report = {}
+    imgs = []
+    cap = _openCapture(in_file)
+    if cap is None:
+        raise IOError(in_file)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    while count is None or len(imgs) < count:
+        with _timed(report, 'decode'):
+            ret, img = cap.read()
+        if not ret:
+            break
+        imgs.append(_reconstruct(img, profile, dirs, reduction, report=report))
+    cap.release()
+    return imgs, report.get('timings', {}), time.perf_counter() - begin
+
+def _convertPipeline(cap: cv2.VideoCapture, img: np.ndarray, profile, dirs, reduction, writer, depth: int, report=None) -> int:
+    # a reader thread decodes into a queue of depth frames, a thread pool converts and encodes them,
+    # and this thread writes them in order. returns the number of frames, raises IOError on write errors.
+    # the pool has as many threads as OpenCV may use, so batch workers limited to one thread stay at one.
+    frames = queue.Queue(depth)
+    stop = threading.Event()
+    read_report = {}
     
-    edges_x = cv2.Scharr(gray, -1, 1, 0);
-    edges_y = cv2.Scharr(gray, -1, 0, 1);
+    def read(img):
+        try:
+            while not stop.is_set():
+                frames.put(img)
+                with _timed(read_report, 'decode'):
+                    ret, img = cap.read()
+                if not ret:
+                    break
+        finally:
+            frames.put(None)
     
-    line_x = np.mean(edges_x, axis=0)
-    line_x = np.log(line_x+1)
+    reader = threading.Thread(target=read, args=(img,), daemon=True)
+    pending = []
+    count = 0
+    with ThreadPoolExecutor(max(cv2.getNumThreads(), 1), thread_name_prefix='repixelator') as executor:
+        reader.start()
+        try:
+            while True:
+                img = frames.get()
+                if img is not None:
+                    pending.append(executor.submit(_convertFrame, img, profile, dirs, reduction, writer))
+                
+                # oldest frame first, the queue and the pool hold at most depth frames each
+                while pending and (len(pending) >= depth or img is None):
+                    out, encoded, timings = pending.pop(0).result()
+                    _addTimings(report, timings)
+                    try:
+                        with _timed(report, 'encode'):
+                            writer.write(out, encoded)
+                    except Exception as e:
+                        raise IOError(e)
+                    count += 1
+                if img is None:
+                    break
+        finally:
+            # unblocks the reader on errors
+            stop.set()
+            while reader.is_alive():
+                try:
+                    frames.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for future in pending:
+                future.cancel()
     
-    line_y = np.mean(edges_y, axis=1)
-    line_y = np.log(line_y+1)
+    _addTimings(report, read_report.get('timings', {}))
+    return count
 
-    def FFT(line):
-        line = line - np.mean(line)
-        n = len(line)
+def _convertFrame(img: np.ndarray, profile, dirs, reduction, writer) -> (np.ndarray, object, dict):
+    # runs in the pipeline threads
+    report = {}
+    img = _reconstruct(img, profile, dirs, reduction, report=report)
+    try:
+        with _timed(report, 'encode'):
+            encoded = writer.encode(img)
+    except Exception as e:
+        raise IOError(e)
+    return img, encoded, report.get('timings', {})
+
+def rePixelateBytes(data, ext='.png', mul=4, nr_sigma=0.0, edge_threshold=1.0, detector='projection', reduction='upscale', report=None, band=0, cache=None, profile=None, encode_params=None, workspace=None) -> (bool, memoryview):
+    # data: bytes, bytearray, memoryview, uint8 array or readable file-like object holding an encoded image or a .npy array
+    # returns the output encoded as ext, as a view of the encoder buffer. animations need rePixelateFile.
+    ret, out = _rePixelateBuffer(_asBuffer(data), ext, encode_params, (mul, nr_sigma, edge_threshold, detector, reduction, report, band, cache, profile, workspace))
+    if ret is None:
+        _log('Image decode error.\nAnimated images need a file path.')
+        return False, memoryview(b'')
+    return ret, out
+
+def _rePixelateBuffer(data, ext: str, encode_params, params: tuple) -> (bool, memoryview):
+    # data: encoded bytes, or an already loaded image array
+    # returns None if data isn't a still image
+    report = params[5]
+    if isinstance(data, np.ndarray) and data.ndim > 1:
+        img = data
+    else:
+        with _timed(report, 'decode'):
+            img = _decode(data)
+        if img is None:
+            return None, memoryview(b'')
+    
+    ret, img = rePixelate(img, *params)
+    if not ret:
+        return False, memoryview(b'')
+    
+    try:
+        with _timed(report, 'encode'):
+            return True, _encode(img, ext, encode_params)
+    except:
+        _log('Image encode error.\nCheck the output file extension.')
+        return False, memoryview(b'')
+
+def detectGridFile(in_file: str, profile_file: str, mul='4', nr_sigma='0.0', detector='projection', reduction='upscale', report=None) -> bool:
+    # detects the grid of an image (the first frame of animations) and saves it as a profile file
+    _log(in_file)
+    
+    with _timed(report, 'decode'):
+        ret, img, cap = _readFile(in_file)
+        if ret and img is None:
+            _, img = cap.read()
+            cap.release()
+    if not ret:
+        return False
+    
+    h, w = img.shape[:2]
+    _log(f'Image: {w}x{h}')
+    if report is not None:
+        report['image'] = [w, h]
+    
+    profile = detectGrid(img, mul if mul == 'auto' else int(mul), float(nr_sigma), detector, report=report, reduction=reduction)
+    if profile is None:
+        return False
+    
+    try:
+        profile.save(profile_file)
+        return True
+    except:
+        _log('Profile write error.\nCheck for write permission.')
+        return False
+
+def _readFile(in_file: str) -> (bool, np.ndarray, object):
+    # returns the image, or the opened capture for animations
+    try:
+        if _isAnimation(in_file):
+            raise ValueError
+        if Path(in_file).suffix.lower() == '.npy':
+            img = np.load(in_file, mmap_mode='r')
+        else:
+            img = _decode(np.fromfile(in_file, dtype='uint8')) # non-ASCII path workaround
+        img.shape
+        return True, img, None
+    except:
+        cap = _openCapture(in_file)
+        return cap is not None, None, cap
+
+def _isAnimation(in_file: str) -> bool:
+    # videos and multi-frame images, cv2.imdecode would only give their first frame
+    suffix = Path(in_file).suffix.lower()
+    if suffix in VIDEO_EXTS:
+        return True
+    if suffix not in ANIMATED_EXTS:
+        return False
+    try:
+        return cv2.imcount(in_file) > 1
+    except:
+        return suffix == '.gif' # the capture reads them all the same
+
+def _openCapture(in_file: str) -> cv2.VideoCapture:
+    try:
+        if Path(in_file).suffix.lower() in ANIMATED_EXTS and hasattr(cv2, 'imdecodeanimation'):
+            # the capture can't read animated WebP, and this also works with non-ASCII paths
+            ret, animation = cv2.imdecodeanimation(np.fromfile(in_file, dtype='uint8'))
+            if ret and len(animation.frames):
+                return AnimationCapture(animation)
+        cap = cv2.VideoCapture(in_file)
+        if cap is None or not cap.isOpened():
+            raise ValueError
+        return cap
+    except:
+        _log('File read error or non-ASCII path error for animated images.')
+        return None
+
+class AnimationCapture():
+    # the part of cv2.VideoCapture used here, over the frames of a decoded animated image
+    def __init__(self, animation):
+        self.frames = list(animation.frames)
+        durations = np.asarray(animation.durations, dtype='float64')
+        self.fps = 1000 / durations.mean() if len(durations) and durations.mean() > 0 else 0.0
+        self.pos = 0
+    
+    def isOpened(self) -> bool:
+        return self.pos < len(self.frames)
+    
+    def read(self) -> (bool, np.ndarray):
+        if self.pos >= len(self.frames):
+            return False, None
+        img = self.frames[self.pos]
+        self.frames[self.pos] = None # read frames aren't kept
+        self.pos += 1
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        return True, img
+    
+    def grab(self) -> bool:
+        return self.read()[0]
+    
+    def get(self, prop) -> float:
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.frames)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.pos
+        return 0.0
+    
+    def set(self, prop, value) -> bool:
+        return False
+    
+    def release(self):
+        self.frames = []
+
+def _captureFrames(cap: cv2.VideoCapture, img: np.ndarray, step=1, report=None):
+    # yields the first frame and every step-th frame after it, the skipped frames aren't decoded
+    while True:
+        yield img
+        with _timed(report, 'decode'):
+            for _ in range(max(step, 1) - 1):
+                if not cap.grab():
+                    return
+            ret, img = cap.read()
+        if not ret:
+            return
+
+def _asBuffer(data):
+    # bytes-like objects are used in place, file-like objects are read once
+    if hasattr(data, 'getbuffer'): # BytesIO
+        return data.getbuffer()
+    if hasattr(data, 'read'):
+        return data.read()
+    return data
+
+def _decode(data) -> np.ndarray:
+    # decodes a bytes-like object without copying it, None if it isn't a still image
+    buf = np.frombuffer(data, dtype='uint8')
+    if buf[:6].tobytes() == b'\x93NUMPY':
+        return np.load(io.BytesIO(buf))
+    try:
+        return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    except cv2.error: # empty buffer
+        return None
+
+def _encode(img: np.ndarray, ext: str, encode_params=None) -> memoryview:
+    if ext.lower() == '.npy':
+        f = io.BytesIO()
+        np.save(f, img)
+        return f.getbuffer()
+    ret, buf = cv2.imencode(ext, img, encode_params or [])
+    if not ret:
+        raise ValueError('encoder error')
+    return memoryview(buf.reshape(-1))
+
+def rePixelate(img: np.ndarray, mul=4, nr_sigma=0.0, edge_threshold=1.0, detector='projection', reduction='upscale', report=None, band=0, cache=None, profile=None, workspace=None) -> (bool, np.ndarray):
+    # report: optional dict, filled with the detection results, the stage timings and the buffer sizes (see _timed)
+    # band: stream the image in bands of this many rows, img can be a memory mapped array
+    # cache: optional GridCache, a hit skips the detection
+    # profile: optional GridProfile to use instead of the detection
+    # workspace: optional Workspace, reuses the intermediate buffers across calls
+    h, w = img.shape[:2]
+    _log(f'Image: {w}x{h}')
+    if report is not None:
+        report['image'] = [w, h]
+    
+    if profile is None:
+        profile = detectGrid(img, mul, nr_sigma, detector, band, cache, report, reduction, workspace)
+        if profile is None:
+            return False, np.array([])
+    
+    return applyGrid(img, profile, edge_threshold, reduction, band, report, workspace)
+
+def rePixelateStack(imgs, mul=4, nr_sigma=0.0, edge_threshold=1.0, detector='projection', reduction='upscale', report=None, profile=None) -> (bool, object):
+    # imgs: (N, H, W, 3) or (N, H, W) array, or a list of images of the same size
+    # returns an (N, h, w, ...) array when every output has the same size, otherwise a list with empty arrays for the failed images.
+    # profile: optional GridProfile applied to every image, the mean, center and median reductions then run on the whole stack at once
+    imgs = np.asarray(imgs)
+    n, h, w = imgs.shape[:3]
+    _log(f'Stack: {n} images of {w}x{h}')
+    if report is not None:
+        report.update(image=[w, h], images=n)
+    if reduction not in REDUCTIONS:
+        _log('Unknown reduction:', reduction)
+        return False, []
+    
+    if profile is not None:
+        ret, dirs = _gridEdges(imgs[0], profile, edge_threshold, reduction, report)
+        if not ret:
+            return False, []
+        if reduction in ('mean', 'center', 'median'): # per channel reductions, the images are stacked as channels
+            c = imgs.shape[3] if imgs.ndim == 4 else 1
+            grid = (profile.conv_x, profile.conv_y, profile.offset_x, profile.offset_y) + tuple(dirs)
+            with _timed(report, 'reduce'):
+                out = _reduceGrid(np.moveaxis(imgs.reshape(n, h, w, c), 0, 2).reshape(h, w, n*c), reduction, *grid)
+            out = np.moveaxis(out.reshape(out.shape[0], out.shape[1], n, c), 2, 0)
+            return True, out if imgs.ndim == 4 else out[..., 0]
+        profiles = [profile] * n
+    else:
+        profiles = detectGridStack(imgs, mul, nr_sigma, detector, report, reduction)
+    
+    outs = []
+    for img, grid in zip(imgs, profiles):
+        if grid is None:
+            outs.append(np.array([]))
+            continue
+        dirs = grid.edges(edge_threshold)
+        outs.append(_reconstruct(img, grid, dirs, reduction, report=report))
+    
+    ok = all(grid is not None for grid in profiles)
+    _log(f'{sum(grid is not None for grid in profiles)}/{n} images converted')
+    if ok and len({out.shape for out in outs}) == 1:
+        return True, np.stack(outs)
+    return ok, outs
+
+
+class AnimationWriter():
+    # writes the converted frames of an animation, see ANIMATIONS.
+    # animated images merge identical consecutive frames into one longer frame, videos keep a constant frame rate.
+    def __init__(self, out_file: str, animation='auto', fps=0.0, encode_params=None):
+        self.out_file = str(out_file)
+        self.ext = Path(out_file).suffix.lower()
+        if animation == 'auto':
+            animation = 'container' if self.ext in VIDEO_EXTS else 'frames'
+        self.mode = 'frames' if animation == 'frames' else 'video' if self.ext in VIDEO_EXTS else 'animation'
+        self.fps = fps if fps and 0 < fps <= 1000 else DEFAULT_FPS
+        self.encode_params = encode_params or []
         
-        complex = np.fft.fft(line)
-        mag = np.abs(complex) / n
-        phase = np.rad2deg(np.angle(complex))
+        self.frames = 0 # frames given
+        self.written = 0 # frames in the output
+        self.duplicates = 0 # frames merged into the previous one
+        self.video = None
+        self.images = []
+        self.durations = []
+        self.last_hash = None
+    
+    def encode(self, img: np.ndarray) -> object:
+        # the part of write that doesn't depend on the other frames, several threads may run it at once
+        if self.mode == 'frames':
+            return _encode(img, self.ext, self.encode_params)
+        if self.mode == 'animation':
+            # output frames are small, hashing them is cheap
+            return hashlib.blake2b(np.ascontiguousarray(img).data, digest_size=16).digest()
+        return None
+    
+    def supported(self) -> bool:
+        # animated images are encoded with cv2.imencodeanimation, added in OpenCV 4.12
+        return self.mode != 'animation' or hasattr(cv2, 'imencodeanimation')
+    
+    def write(self, img: np.ndarray, encoded=None):
+        # raises on write errors, encoded is the result of encode for this image
+        self.frames += 1
+        if encoded is None:
+            encoded = self.encode(img)
+        
+        if self.mode == 'frames':
+            path = str(Path(self.out_file).parent / Path(self.out_file).stem) + f'_frame{self.frames:04d}' + str(Path(self.out_file).suffix)
+            with open(path, 'wb') as f: # non-ASCII path workaround
+                f.write(encoded)
+            
+        elif self.mode == 'video':
+            if self.video is None:
+                h, w = img.shape[:2]
+                self.video = cv2.VideoWriter(self.out_file, cv2.VideoWriter_fourcc(*VIDEO_CODECS.get(self.ext, 'mp4v')), self.fps, (w, h), img.ndim == 3)
+                if not self.video.isOpened():
+                    raise IOError(self.out_file)
+            self.video.write(img)
+            
+        else:
+            if encoded == self.last_hash:
+                self.durations[-1] += 1000 / self.fps
+                self.duplicates += 1
+                return
+            self.last_hash = encoded
+            self.images.append(img)
+            self.durations.append(1000 / self.fps)
+            
+        self.written += 1
+    
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+        
+        if self.mode == 'animation' and self.images:
+            if not self.supported():
+                raise NotImplementedError('animated images need OpenCV 4.12 or higher')
+            anim = cv2.Animation()
+            anim.frames = self.images
+            anim.durations = [int(round(d)) for d in self.durations]
+            anim.loop_count = 0
+            ret, buf = cv2.imencodeanimation(self.ext, anim, self.encode_params)
+            if not ret:
+                raise IOError(self.out_file)
+            with open(self.out_file, 'wb') as f: # non-ASCII path workaround
+                f.write(buf)
+            self.images = []
+
+
+class GridProfile():
+    # detected pixel grid of an image, applies to any image of the same size.
+    # offsets are the grid phase in original image pixels, mul is only used by the upscale reconstruction.
+    
+    def __init__(self, width: int, height: int, conv_x: int, conv_y: int, offset_x: float, offset_y: float, mul=4, confidence=0.0, detector='projection'):
+        self.width = int(width)
+        self.height = int(height)
+        self.conv_x = int(conv_x)
+        self.conv_y = int(conv_y)
+        self.offset_x = float(offset_x)
+        self.offset_y = float(offset_y)
+        self.mul = int(mul)
+        self.confidence = float(confidence)
+        self.detector = detector
+    
+    def pixelSize(self) -> (float, float):
+        return self.width / self.conv_x, self.height / self.conv_y
+    
+    def edges(self, edge_threshold=1.0) -> (int, int):
+        # edges to include, -1 for left/up, 1 for right/down
+        dir_x, dir_y = 0, 0
+        if edge_threshold > 0:
+            dir_x = int(np.sign(self.offset_x)) if abs(self.offset_x) > edge_threshold else 0
+            dir_y = int(np.sign(self.offset_y)) if abs(self.offset_y) > edge_threshold else 0
+        return dir_x, dir_y
+    
+    def outputSize(self, edge_threshold=1.0) -> (int, int):
+        dir_x, dir_y = self.edges(edge_threshold)
+        return self.conv_x + abs(dir_x), self.conv_y + abs(dir_y)
+    
+    def toDict(self) -> dict:
+        return {
+            'version': PROFILE_VERSION,
+            'width': self.width,
+            'height': self.height,
+            'conv_x': self.conv_x,
+            'conv_y': self.conv_y,
+            'offset_x': self.offset_x,
+            'offset_y': self.offset_y,
+            'mul': self.mul,
+            'confidence': self.confidence,
+            'detector': self.detector,
+        }
+    
+    @classmethod
+    def fromDict(cls, data: dict):
+        data = dict(data)
+        data.pop('version', None)
+        return cls(**data)
+    
+    def save(self, file: str):
+        with open(file, 'w', encoding='utf-8') as f:
+            json.dump(self.toDict(), f, indent=4)
+    
+    @classmethod
+    def load(cls, file: str):
+        with open(file, encoding='utf-8') as f:
+            return cls.fromDict(json.load(f))
+    
+    def __repr__(self):
+        return f'GridProfile({self.width}x{self.height} -> {self.conv_x}x{self.conv_y}, offset {self.offset_x:.2f}x{self.offset_y:.2f})'
+
 
-        mag = mag[range(int(n / 2))]
-        phase = phase[range(int(n / 2))]
+class GridAccumulator():
+    # sums the edge projections of many frames of one size and re-runs only the 1D FFT on the sums,
+    # so a fade-in or a dark first frame doesn't decide the grid of the whole animation.
+    def __init__(self, width: int, height: int, mul=4, nr_sigma=0.0, detector='projection'):
+        self.width = width
+        self.height = height
+        self.mul = mul
+        self.nr_sigma = nr_sigma
+        self.detector = detector
+        
+        self.sum_x = None
+        self.sum_y = None
+        self.frames = 0 # frames with edges
+        self.stable = 0 # consecutive frames with the current FFT size
+        self.result = (0, 0, 0.0, 0.0, 0.0)
+    
+    def add(self, img: np.ndarray, report=None) -> bool:
+        # returns True once the result is stable
+        line_x, line_y = _detectLines(img, self.mul, self.nr_sigma, self.detector, 0, report)
+        if not line_x.any() and not line_y.any(): # blank frame, it would only dilute the sums
+            return self.done()
         
-        start = int(max(n/mul/50, 4)) # down to 1/50 scale OR at least 4x4 converted size
-        index = np.argmax(mag[start:]) + start
-        phase = phase[index]
+        if self.sum_x is None:
+            self.sum_x = np.zeros(len(line_x), dtype='float64')
+            self.sum_y = np.zeros(len(line_y), dtype='float64')
+        self.sum_x += line_x
+        self.sum_y += line_y
+        self.frames += 1
         
-        return index, phase
+        # the FFT peaks don't depend on the scale of the lines, the sums work as the mean
+        result = _detectPeaks(self.sum_x, self.sum_y, self.width, self.height, self.mul, self.detector, report)
+        self.stable = self.stable + 1 if result[:2] == self.result[:2] else 1
+        self.result = result
+        return self.done()
     
-    conv_x, phase_x = FFT(line_x)
-    conv_y, phase_y = FFT(line_y)
-    print(f'FFT: {conv_x}x{conv_y}')
-    print(f'Pixel size: {w/mul/conv_x:.3f}x{h/mul/conv_y:.3f}')
-    if not conv_x or not conv_y:
-        print('FFT error')
-        return False, np.array([])
+    def done(self) -> bool:
+        return self.stable >= ANALYSIS_STABLE and self.result[4] >= AUTO_CONFIDENCE
     
-    # calc offset
-    pixsize_x = w / conv_x
-    pixsize_y = h / conv_y
-    offset_x = pixsize_x * phase_x / 360
-    offset_y = pixsize_y * phase_y / 360
-    print(f'Offset: x={offset_x/mul:.2f}, y={offset_y/mul:.2f}')
+    def profile(self) -> GridProfile:
+        return GridProfile(self.width, self.height, *self.result[:4], self.mul, self.result[4], self.detector)
+
+
+class GridMap():
+    # per tile grids of an image, see detectTiles.
+    # rects are (x, y, w, h) of the tiles, pixels the refined pixel sizes, offsets and confidences as in GridProfile.
+    def __init__(self, width: int, height: int, mul, rects: list, results: list):
+        self.width = width
+        self.height = height
+        self.mul = mul
+        self.rects = np.array(rects, dtype='int64').reshape(-1, 4)
+        results = np.array(results, dtype='float64').reshape(-1, 7)
+        self.convs = results[:, 0:2].astype('int64')
+        self.pixels = results[:, 2:4]
+        self.offsets = results[:, 4:6]
+        self.confidences = results[:, 6]
     
-    # process offset pixels
-    if edge_threshold > 0:
-        edge_threshold *= mul
+    def __len__(self):
+        return len(self.rects)
+    
+    def profile(self, i: int) -> GridProfile:
+        # grid of tile i, for applyGrid on img[y:y+h, x:x+w]
+        x, y, w, h = self.rects[i]
+        return GridProfile(w, h, *self.convs[i], *self.offsets[i], self.mul, self.confidences[i], 'tiles')
+    
+    def votes(self, min_confidence=0.0, tolerance=TILE_TOLERANCE) -> list:
+        # groups the tiles by pixel size, returns [(pixel_x, pixel_y, mean confidence, tile indices)] with the most tiles first.
+        # small tiles often stay below AUTO_CONFIDENCE, so every tile with edges votes by default.
+        groups = []
+        for i in np.argsort(-self.confidences):
+            if self.confidences[i] <= 0 or self.confidences[i] < min_confidence or not np.all(self.pixels[i] > 0):
+                continue
+            for group in groups:
+                if np.all(np.abs(self.pixels[i] / self.pixels[group[0]] - 1) <= tolerance):
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
         
-        dir_x = np.sign(offset_x) if abs(offset_x) > edge_threshold else 0
-        dir_y = np.sign(offset_y) if abs(offset_y) > edge_threshold else 0
+        votes = []
+        for group in groups:
+            weights = self.confidences[group]
+            pixel_x, pixel_y = np.average(self.pixels[group], axis=0, weights=weights)
+            votes.append((float(pixel_x), float(pixel_y), float(np.mean(weights)), [int(i) for i in group]))
+        return sorted(votes, key=lambda vote: (-len(vote[3]), -vote[2]))
+    
+    def dominant(self, min_confidence=0.0, tolerance=TILE_TOLERANCE) -> GridProfile:
+        # grid of the whole image from the best vote, None if no tile has a grid
+        votes = self.votes(min_confidence, tolerance)
+        if not votes:
+            return None
+        pixel_x, pixel_y, confidence, tiles = votes[0]
+        _log(f'Dominant grid: {len(tiles)}/{len(self)} tiles')
         
-        if dir_x or dir_y:
-            new_w, new_h = w, h
-            pxxi, pxyi = round(pixsize_x), round(pixsize_y)
-            
-            # determine edges to include
-            if dir_x:
-                print('Left' if dir_x < 0 else 'Right', end='')
-                new_w += pxxi
-                conv_x += 1
-                
-            if dir_x and dir_y:
-                print('+', end='')
-                
-            if dir_y:
-                print('Up' if dir_y < 0 else 'Down', end='')
-                new_h += pxyi
-                conv_y += 1
-                
-            print(' edge included')
+        weights = self.confidences[tiles]
+        conv_x = max(int(round(self.width / pixel_x)), 1)
+        conv_y = max(int(round(self.height / pixel_y)), 1)
+        offset_x = self._offset(0, tiles, weights, self.width / conv_x)
+        offset_y = self._offset(1, tiles, weights, self.height / conv_y)
+        return GridProfile(self.width, self.height, conv_x, conv_y, offset_x, offset_y, self.mul, confidence, 'tiles')
+    
+    def _offset(self, axis: int, tiles: list, weights: np.ndarray, pixsize: float) -> float:
+        # circular mean of the grid line positions near the tile centers, moved to the image origin
+        start = self.rects[tiles, axis]
+        size = self.rects[tiles, axis+2]
+        tile_pixsize = size / self.convs[tiles, axis]
+        origin = start - self.offsets[tiles, axis]
+        line = origin + np.round((size / 2 - origin + start) / tile_pixsize) * tile_pixsize
+        
+        angle = np.angle(np.sum(weights * np.exp(2j * np.pi * line / pixsize)))
+        return float(-angle / (2 * np.pi) * pixsize)
+    
+    def toDict(self) -> dict:
+        return {
+            'width': self.width,
+            'height': self.height,
+            'rects': self.rects.tolist(),
+            'pixels': self.pixels.tolist(),
+            'offsets': self.offsets.tolist(),
+            'confidences': self.confidences.tolist(),
+        }
+
+
+class GridPreview():
+    # staged detection and reconstruction of one image, for interactive parameter changes.
+    # every stage keeps its last result with the parameters it depends on, so a change only recomputes the stages after it:
+    # gray <- blur (nr_sigma, mul) <- lines <- peaks (spectrum) <- profile <- output (edge_threshold, reduction).
+    # the 'upscale' detector adds the pre zoomed gray (mul) before the blur, and the 'upscale' reduction keeps
+    # the pre zoomed image (mul), so an edge threshold change only redoes the offset and the shrink.
+    
+    def __init__(self, img: np.ndarray):
+        self.img = img
+        self.height, self.width = img.shape[:2]
+        self.stages = {}
+        self.profile = None
+        self.output = None
+        self.log = []
+    
+    def update(self, mul=4, nr_sigma=0.0, edge_threshold=1.0, detector='projection', reduction='upscale', profile=None, report=None) -> (bool, np.ndarray):
+        # same result as rePixelate, a given profile skips the detection.
+        # report['stages'] lists the stages that were computed again, the messages go to self.log
+        self.log = []
+        self.profile = None
+        self.output = None
+        if report is not None:
+            report['stages'] = []
+        
+        with _threadLogger(self.log.append):
+            if detector not in DETECTORS:
+                _log('Unknown detector:', detector)
+                return False, np.array([])
+            if profile is None:
+                key = (mul, nr_sigma, detector, reduction if mul == 'auto' else None)
+                profile = _checkProfile(self._stage('profile', key, lambda: self._detect(mul, nr_sigma, detector, reduction, report), report), report)
             
-            # paste image to new canvas
-            new_img = np.zeros((new_h, new_w, c), dtype='uint8')
+            ret, dirs = _gridEdges(self.img, profile, edge_threshold, reduction, report)
+            if not ret:
+                return False, np.array([])
             
-            if dir_x >= 0 and dir_y >= 0:
-                new_img[:h, :w] = img
-            elif dir_x < 0 and dir_y >= 0:
-                new_img[:h, new_w-w:] = img
-            elif dir_x >= 0 and dir_y < 0:
-                new_img[new_h-h:, :w] = img
-            elif dir_x < 0 and dir_y < 0:
-                new_img[new_h-h:, new_w-w:] = img
+            key = (tuple(profile.toDict().items()), dirs, reduction)
+            self.profile = profile
+            self.output = self._stage('output', key, lambda: self._reconstruct(profile, dirs, reduction, report), report)
+        return True, self.output
+    
+    def overlay(self, max_size=0, color=(0, 0, 255)) -> np.ndarray:
+        # BGR image with the grid lines of the last update, scaled down to fit into max_size pixels.
+        # lines closer than 3 display pixels are thinned out.
+        scale = min(max_size / max(self.width, self.height), 1.0) if max_size else 1.0
+        img = self._stage('display', scale, lambda: _bgr(cv2.resize(self.img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else self.img)).copy()
+        if self.profile is None:
+            return img
+        
+        h, w = img.shape[:2]
+        pixsize_x, pixsize_y = self.profile.pixelSize()
+        for axis, pixsize, offset, n in ((1, pixsize_x, self.profile.offset_x, w), (0, pixsize_y, self.profile.offset_y, h)):
+            step = pixsize * max(int(np.ceil(3 / (pixsize * scale))), 1)
+            lines = np.round((-offset % step + np.arange(0, self.width if axis else self.height, step)) * scale).astype('int64')
+            lines = lines[lines < n]
+            if axis:
+                img[:, lines] = color
+            else:
+                img[lines, :] = color
+        return img
+    
+    def result(self, max_size=0) -> np.ndarray:
+        # BGR output of the last update scaled up with nearest neighbor to fit into max_size pixels, None without an output
+        if self.output is None or not self.output.size:
+            return None
+        h, w = self.output.shape[:2]
+        scale = max(int(max_size / max(w, h)), 1) if max_size else 1
+        return _bgr(cv2.resize(self.output, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST))
+    
+    def _stage(self, name: str, key, compute, report=None):
+        # last result of a stage, computed again when its key changed
+        cached = self.stages.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = compute()
+        self.stages[name] = (key, value)
+        if report is not None:
+            report['stages'].append(name)
+        return value
+    
+    def _reconstruct(self, profile: GridProfile, dirs: (int, int), reduction='upscale', report=None) -> np.ndarray:
+        if reduction != 'upscale':
+            return _reconstruct(self.img, profile, dirs, reduction, 0, report)
+        # the margin covers the included edge and the offset, so they don't copy the pre zoomed image
+        margin = int(np.ceil(max(profile.pixelSize()) * 2 + 1)) * profile.mul
+        with _timed(report, 'upscale'):
+            img = self._stage('zoom', (profile.mul, margin), lambda: cv2.copyMakeBorder(_upscale(self.img, profile.mul), *(margin,)*4, cv2.BORDER_REPLICATE), report)
+        return _shrinkGrid(img, profile.mul, profile.conv_x, profile.conv_y, profile.offset_x, profile.offset_y, *dirs, report, margin=margin)
+    
+    def _detect(self, mul, nr_sigma, detector, reduction, report=None) -> GridProfile:
+        # detectGrid on the cached stages, the tiles detector has its own per tile pipeline
+        w, h = self.width, self.height
+        if detector == 'tiles':
+            mul = AUTO_MULS[-1] if mul == 'auto' else mul
+            grid = detectTiles(self.img, mul=mul, nr_sigma=nr_sigma, report=report).dominant()
+            return grid or GridProfile(w, h, 0, 0, 0.0, 0.0, mul, 0.0, detector)
+        
+        if mul == 'auto' and detector != 'upscale' and not nr_sigma:
+            conv_x, conv_y, offset_x, offset_y, confidence = self._peaks(AUTO_MULS[0], nr_sigma, detector, report)
+            m = _autoMul(w, h, conv_x, conv_y, reduction)
+            shift = _centerShift(m) - _centerShift(AUTO_MULS[0])
+            _log(f'Auto pre zoom: x{m}, confidence {confidence:.2f}')
+            return GridProfile(w, h, conv_x, conv_y, offset_x - shift, offset_y - shift, m, confidence, detector)
+        
+        for m in (AUTO_MULS if mul == 'auto' else (mul,)):
+            conv_x, conv_y, offset_x, offset_y, confidence = self._peaks(m, nr_sigma, detector, report)
+            if mul != 'auto':
+                break
+            _log(f'Auto pre zoom: x{m}, confidence {confidence:.2f}')
+            if not conv_x or not conv_y or confidence < AUTO_CONFIDENCE:
+                continue
+            if reduction == 'upscale' and min(w/conv_x, h/conv_y) * m < AUTO_PIXSIZE:
+                continue
+            break
+        return GridProfile(w, h, conv_x, conv_y, offset_x, offset_y, m, confidence, detector)
+    
+    def _peaks(self, mul, nr_sigma, detector, report=None) -> (int, int, float, float, float):
+        # stages are kept per mul, so the auto pre zoom reuses all of them
+        if detector == 'upscale':
+            gray = self._stage(f'upscale{mul}', None, lambda: _gray(cv2.resize(self.img, None, fx=mul, fy=mul, interpolation=cv2.INTER_LINEAR)), report)
+            sigma = nr_sigma
+        else:
+            gray = self._stage('gray', None, lambda: _gray(np.ascontiguousarray(self.img)), report)
+            sigma = nr_sigma / mul # nr_sigma is given in pre zoomed pixels
+        
+        key = (detector, nr_sigma)
+        blur = self._stage(f'blur{mul}', key, lambda: cv2.GaussianBlur(gray, (0, 0), sigma, borderType=cv2.BORDER_REPLICATE) if nr_sigma > 0 else gray, report)
+        if detector == 'upscale':
+            lines = self._stage(f'lines{mul}', key, lambda: _scharrLines(blur, report), report)
+        else:
+            lines = self._stage(f'lines{mul}', key, lambda: _projectionLines(blur, mul, 0.0, 0, report), report)
+        return self._stage(f'peaks{mul}', key, lambda: _detectPeaks(*lines, self.width, self.height, mul, detector, report), report)
+
+
+class Workspace():
+    # reusable buffers of the detection and the upscale reconstruction, for workers converting many images.
+    # one buffer per name, grown to the largest size asked for, so images of similar sizes don't allocate and page fault again.
+    # buffers that would take the total above limit bytes are allocated per call instead. one workspace per thread.
+    
+    def __init__(self, limit=WORKSPACE_LIMIT):
+        self.limit = int(limit)
+        self.buffers = {}
+        self.peak = 0 # high-water mark of the kept buffers, in bytes
+    
+    def get(self, name: str, shape: tuple, dtype='uint8') -> np.ndarray:
+        # contiguous array of this shape on the buffer of that name, the content is undefined
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buf = self.buffers.get(name)
+        if buf is None or buf.nbytes < size:
+            buf = np.empty(max(size, 1), dtype='uint8')
+            if self.nbytes() - self.buffers.get(name, buf[:0]).nbytes + buf.nbytes > self.limit:
+                return buf[:size].view(dtype).reshape(shape)
+            self.buffers[name] = buf
+            self.peak = max(self.peak, self.nbytes())
+        return buf[:size].view(dtype).reshape(shape)
+    
+    def nbytes(self) -> int:
+        return sum(buf.nbytes for buf in self.buffers.values())
+    
+    def clear(self):
+        # frees the buffers, the peak is kept
+        self.buffers = {}
+    
+    def __repr__(self):
+        return f'Workspace({len(self.buffers)} buffers, {self.nbytes() / 2**20:.1f}MB, peak {self.peak / 2**20:.1f}MB)'
+
+
+def detectGrid(img: np.ndarray, mul=4, nr_sigma=0.0, detector='projection', band=0, cache=None, report=None, reduction='upscale', workspace=None) -> GridProfile:
+    # returns None if no grid is found.
+    # reduction is the reconstruction the grid is meant for, mul='auto' needs it to pick the pre zoom.
+    h, w = img.shape[:2]
+    
+    if detector not in DETECTORS:
+        _log('Unknown detector:', detector)
+        return None
+    if band and detector == 'upscale':
+        _log('Band streaming needs the projection detector')
+        return None
+    
+    profile = None
+    if cache is not None:
+        with _timed(report, 'hash'):
+            key = cache.key(img, mul, nr_sigma, detector, reduction, band)
+        try:
+            profile = GridProfile.fromDict(cache.get(key))
+            _log('Cache hit')
+        except (TypeError, ValueError): # miss or unreadable entry
+            pass
+    hit = profile is not None
+    
+    if profile is None and detector == 'tiles':
+        # the tiles use the projection detector, which costs the same for every mul
+        grid = detectTiles(img, mul=AUTO_MULS[-1] if mul == 'auto' else mul, nr_sigma=nr_sigma, report=report).dominant()
+        profile = grid or GridProfile(w, h, 0, 0, 0.0, 0.0, AUTO_MULS[-1] if mul == 'auto' else mul, 0.0, detector)
+        if cache is not None:
+            cache.put(key, profile.toDict())
+    
+    if profile is None:
+        if mul == 'auto' and detector != 'upscale' and not nr_sigma:
+            conv_x, conv_y, offset_x, offset_y, confidence = _detect(img, AUTO_MULS[0], nr_sigma, detector, band, report, workspace)
+            mul = _autoMul(w, h, conv_x, conv_y, reduction, band)
+            shift = _centerShift(mul) - _centerShift(AUTO_MULS[0]) # the only difference between the muls
+            offset_x, offset_y = offset_x - shift, offset_y - shift
+            _log(f'Auto pre zoom: x{mul}, confidence {confidence:.2f}')
+        elif mul == 'auto':
+            for mul in AUTO_MULS:
+                conv_x, conv_y, offset_x, offset_y, confidence = _detect(img, mul, nr_sigma, detector, band, report, workspace)
+                _log(f'Auto pre zoom: x{mul}, confidence {confidence:.2f}')
+                if not conv_x or not conv_y or confidence < AUTO_CONFIDENCE:
+                    continue
+                if reduction == 'upscale' and not band and min(w/conv_x, h/conv_y) * mul < AUTO_PIXSIZE:
+                    continue
+                break
+        else:
+            conv_x, conv_y, offset_x, offset_y, confidence = _detect(img, mul, nr_sigma, detector, band, report, workspace)
+        
+        profile = GridProfile(w, h, conv_x, conv_y, offset_x, offset_y, mul, confidence, detector)
+        if cache is not None:
+            cache.put(key, profile.toDict())
+    
+    if report is not None and cache is not None:
+        report['cache'] = 'hit' if hit else 'miss'
+    
+    return _checkProfile(profile, report)
+
+def detectGridFrames(frames, mul=4, nr_sigma=0.0, detector='projection', max_frames=30, report=None, reduction='upscale') -> GridProfile:
+    # detects one grid from the frames of an animation, frames is an iterable of images of the same size.
+    # stops early once the result is stable, returns None if no grid is found.
+    if detector not in DETECTORS:
+        _log('Unknown detector:', detector)
+        return None
+    if mul == 'auto':
+        # the projection detector costs the same for every mul, the upscale reconstruction wants the largest
+        mul = AUTO_MULS[-1]
+        _log(f'Auto pre zoom: x{mul} for the multi-frame analysis')
+    
+    grid = None
+    count = 0
+    for img in frames:
+        if grid is None:
+            h, w = img.shape[:2]
+            grid = GridAccumulator(w, h, mul, nr_sigma, detector)
+        count += 1
+        if grid.add(img, report) or count >= max_frames:
+            break
+    if grid is None:
+        return None
+    
+    _log(f'Analyzed {count} frames, {grid.frames} with edges')
+    if report is not None:
+        report.update(analysis_frames=count, analysis_stable=grid.stable >= ANALYSIS_STABLE)
+    return _checkProfile(grid.profile(), report)
+
+def detectTiles(img: np.ndarray, tile=TILE_SIZE, overlap=TILE_OVERLAP, mul=4, nr_sigma=0.0, jobs=0, report=None) -> GridMap:
+    # detects the grid of each overlapping tile of the image with the projection detector.
+    # the tiles are analyzed by jobs threads (default: CPU count), OpenCV and numpy release the GIL.
+    h, w = img.shape[:2]
+    step = max(int(tile * (1 - overlap)), 1)
+    xs = _tileStarts(w, tile, step)
+    ys = _tileStarts(h, tile, step)
+    rects = [(x, y, min(tile, w), min(tile, h)) for y in ys for x in xs]
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as executor:
+        results = list(executor.map(lambda rect: _detectTile(img, *rect, mul, nr_sigma), rects))
+    _addTime(report, 'tiles', start)
+    
+    grid = GridMap(w, h, mul, rects, results)
+    _log(f'Tiles: {len(xs)}x{len(ys)} of {tile}px')
+    if report is not None:
+        report['tiles'] = [len(xs), len(ys)]
+    return grid
+
+def detectGridStack(imgs, mul=4, nr_sigma=0.0, detector='projection', report=None, reduction='upscale') -> list:
+    # detects the grid of every image of an (N, H, W, ...) stack, returns a list of GridProfile or None.
+    # the projection detector analyzes chunks of images at once and runs the FFT peak search on all their lines together,
+    # the other detectors and mul='auto' go through detectGrid one image at a time.
+    imgs = np.asarray(imgs)
+    n, h, w = imgs.shape[:3]
+    if detector != 'projection' or mul == 'auto':
+        return [detectGrid(img, mul, nr_sigma, detector, report=report, reduction=reduction) for img in imgs]
+    
+    chunk = max(STACK_PIXELS // (h * w), 1)
+    shift = _centerShift(mul)
+    profiles = []
+    for i in range(0, n, chunk):
+        lines_x, lines_y = _projectionStack(imgs[i:i+chunk], mul, nr_sigma, report)
+        with _timed(report, 'fft'):
+            conv_x, phase_x, _, confidence_x = _projectionFFT(lines_x, w, mul)
+            conv_y, phase_y, _, confidence_y = _projectionFFT(lines_y, h, mul)
+        
+        for j in range(len(lines_x)):
+            if not conv_x[j] or not conv_y[j]:
+                profiles.append(None)
+                continue
+            # same arithmetic as _detectPeaks
+            offset_x = w / int(conv_x[j]) * phase_x[j] / 360 - shift
+            offset_y = h / int(conv_y[j]) * phase_y[j] / 360 - shift
+            profiles.append(GridProfile(w, h, conv_x[j], conv_y[j], offset_x, offset_y, mul, min(float(confidence_x[j]), float(confidence_y[j])), detector))
+    
+    grids = {(grid.conv_x, grid.conv_y) for grid in profiles if grid is not None}
+    _log(f'Grids: {len(grids)} distinct, {profiles.count(None)} failed')
+    if report is not None:
+        report['grids'] = [grid.toDict() if grid is not None else None for grid in profiles]
+    return profiles
+
+def _tileStarts(n, tile, step) -> list:
+    # the last tile ends at the image edge
+    if n <= tile:
+        return [0]
+    starts = list(range(0, n - tile + 1, step))
+    if starts[-1] != n - tile:
+        starts.append(n - tile)
+    return starts
+
+def _checkProfile(profile: GridProfile, report=None) -> GridProfile:
+    if report is not None:
+        report.update(mul=profile.mul, confidence=profile.confidence, conv_x=profile.conv_x, conv_y=profile.conv_y, offset_x=profile.offset_x, offset_y=profile.offset_y)
+    
+    _log(f'FFT: {profile.conv_x}x{profile.conv_y}')
+    if not profile.conv_x or not profile.conv_y:
+        _log('FFT error')
+        return None
+    _log('Pixel size: {:.3f}x{:.3f}'.format(*profile.pixelSize()))
+    _log(f'Offset: x={profile.offset_x:.2f}, y={profile.offset_y:.2f}')
+    _log(f'Confidence: {profile.confidence:.2f}')
+    
+    return profile
+
+def applyGrid(img: np.ndarray, profile: GridProfile, edge_threshold=1.0, reduction='upscale', band=0, report=None, workspace=None) -> (bool, np.ndarray):
+    ret, dirs = _gridEdges(img, profile, edge_threshold, reduction, report)
+    if not ret:
+        return False, np.array([])
+    if band and reduction == 'upscale':
+        _log('Band streaming uses the mean reduction')
+        reduction = 'mean'
+    
+    return True, _reconstruct(img, profile, dirs, reduction, band, report, workspace)
+
+def _gridEdges(img: np.ndarray, profile: GridProfile, edge_threshold=1.0, reduction='upscale', report=None) -> (bool, (int, int)):
+    # checks the profile against the image and determines the edges to include
+    if profile is None:
+        return False, (0, 0)
+    if reduction not in REDUCTIONS:
+        _log('Unknown reduction:', reduction)
+        return False, (0, 0)
+    
+    h, w = img.shape[:2]
+    if (w, h) != (profile.width, profile.height):
+        _log(f'Image size {w}x{h} doesn\'t match the grid profile ({profile.width}x{profile.height})')
+        return False, (0, 0)
+    
+    # process offset pixels
+    dir_x, dir_y = profile.edges(edge_threshold)
+    
+    if dir_x or dir_y:
+        # determine edges to include
+        edges = []
+        if dir_x:
+            edges.append('Left' if dir_x < 0 else 'Right')
             
-            img = new_img
-            h, w, c = img.shape
+        if dir_y:
+            edges.append('Up' if dir_y < 0 else 'Down')
             
-            # fill border
-            oxi, oyi = int(-pxxi*dir_x), int(-pxyi*dir_y)
+        _log('+'.join(edges) + ' edge included')
+    
+    out_w, out_h = profile.outputSize(edge_threshold)
+    _log(f'Final: {out_w}x{out_h}')
+    if report is not None:
+        report.update(out_w=out_w, out_h=out_h)
+    
+    return True, (dir_x, dir_y)
+
+def _reconstruct(img: np.ndarray, profile: GridProfile, dirs: (int, int), reduction='upscale', band=0, report=None, workspace=None) -> np.ndarray:
+    grid = (profile.conv_x, profile.conv_y, profile.offset_x, profile.offset_y) + tuple(dirs)
+    if reduction == 'upscale':
+        return _upscaleGrid(img, profile.mul, *grid, report=report, workspace=workspace)
+    with _timed(report, 'reduce'):
+        return _reduceGrid(img, reduction, *grid, band)
+
+def _upscaleGrid(img: np.ndarray, mul, conv_x, conv_y, offset_x, offset_y, dir_x, dir_y, report=None, workspace=None) -> np.ndarray:
+    # pad, offset and shrink the pre zoomed image
+    with _timed(report, 'upscale'):
+        img = _upscale(img, mul, workspace)
+    _buffer(report, img)
+    return _shrinkGrid(img, mul, conv_x, conv_y, offset_x, offset_y, dir_x, dir_y, report, workspace)
+
+def _shrinkGrid(img: np.ndarray, mul, conv_x, conv_y, offset_x, offset_y, dir_x, dir_y, report=None, workspace=None, margin=0) -> np.ndarray:
+    # img is the pre zoomed image, with margin pixels of replicated border on every side
+    h, w = img.shape[0] - 2*margin, img.shape[1] - 2*margin
+    
+    # offsets in upscaled pixels
+    pixsize_x = w / conv_x
+    pixsize_y = h / conv_y
+    offset_x *= mul
+    offset_y *= mul
+    
+    # the included edges add one pixel filled with the border, and the offset moves the image by whole pixels with the border replicated.
+    # both only pick rows and columns of the image, so they are done in one copy, or none when the margin holds the border
+    pxxi, pxyi = round(pixsize_x), round(pixsize_y)
+    new_w, new_h = w + pxxi * bool(dir_x), h + pxyi * bool(dir_y)
+    conv_x += bool(dir_x)
+    conv_y += bool(dir_y)
+    
+    with _timed(report, 'warp'):
+        start_x, end_x, left, right = _shiftRange(w, new_w, int(offset_x) + (pxxi if dir_x < 0 else 0))
+        start_y, end_y, top, bottom = _shiftRange(h, new_h, int(offset_y) + (pxyi if dir_y < 0 else 0))
+        if max(left, right, top, bottom) <= margin:
+            img = img[margin+start_y-top:margin+end_y+bottom, margin+start_x-left:margin+end_x+right]
+        else:
+            img = img[margin+start_y:margin+end_y, margin+start_x:margin+end_x]
+            img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_REPLICATE, _scratch(workspace, 'warp', (new_h, new_w) + img.shape[2:]))
+            _buffer(report, img)
+    
+    # shrink image
+    with _timed(report, 'resize'):
+        img = cv2.resize(img, (conv_x, conv_y), cv2.INTER_AREA)
+    
+    return img
+
+def _shiftRange(n: int, size: int, shift: int) -> (int, int, int, int):
+    # size pixels of a line of n pixels moved by shift with the border replicated:
+    # the start and end of the pixels taken from the line and the border pixels before and after them
+    start = min(max(-shift, 0), n - 1)
+    before = min(max(shift, 0), size - 1)
+    end = min(start + size - before, n)
+    return start, end, before, size - before - (end - start)
+
+def _reduceGrid(img: np.ndarray, reduction, conv_x, conv_y, offset_x, offset_y, dir_x, dir_y, band=0) -> np.ndarray:
+    # reduce each grid cell of the original image to one pixel
+    h, w = img.shape[:2]
+    start_y, end_y = _cellBounds(h, conv_y, offset_y, dir_y)
+    start_x, end_x = _cellBounds(w, conv_x, offset_x, dir_x)
+    
+    gray = img.ndim == 2
+    if gray:
+        img = img[..., None]
+    
+    if not band:
+        out = _reduceCells(img, reduction, start_y, end_y, start_x, end_x)
+    else:
+        # rows of cells that fit into one band, at least one row of cells at a time.
+        # the sample count is taken over the whole image so every band picks the same samples.
+        samples = _sampleCount(start_y, end_y)
+        out = []
+        i = 0
+        while i < len(start_y):
+            y0 = start_y[i]
+            j = max(int(np.searchsorted(end_y, y0 + band, 'right')), i + 1)
+            y1 = int(np.max(end_y[i:j]))
+            out.append(_reduceCells(np.asarray(img[y0:y1]), reduction, start_y[i:j] - y0, end_y[i:j] - y0, start_x, end_x, samples))
+            i = j
+        out = np.concatenate(out)
+    
+    return out[..., 0] if gray else out
+
+def _reduceCells(img: np.ndarray, reduction, start_y, end_y, start_x, end_x, samples_y=0) -> np.ndarray:
+    # samples_y: samples per cell row for median and mode, by default the count of these cells
+    c = img.shape[2]
+    
+    if reduction == 'center':
+        return img[np.ix_((start_y + end_y - 1) // 2, (start_x + end_x - 1) // 2)]
+    
+    if reduction == 'mean':
+        img = _cellSums(img, start_y, end_y)
+        img = _cellSums(img.swapaxes(0, 1), start_x, end_x).swapaxes(0, 1)
+        count = (end_y - start_y)[:, None, None] * (end_x - start_x)[None, :, None]
+        return ((img + count // 2) // count).astype('uint8')
+    
+    # median and mode look at a fixed number of samples per cell
+    samples_y = _cellSamples(start_y, end_y, samples_y or _sampleCount(start_y, end_y))
+    samples_x = _cellSamples(start_x, end_x, _sampleCount(start_x, end_x))
+    ny, ky = samples_y.shape
+    nx, kx = samples_x.shape
+    cells = img[np.ix_(samples_y.ravel(), samples_x.ravel())].reshape(ny, ky, nx, kx, c)
+    cells = cells.transpose(0, 2, 1, 3, 4).reshape(ny, nx, ky*kx, c)
+    
+    if reduction == 'median':
+        return np.round(np.median(cells, axis=2)).astype('uint8')
+    
+    # mode, colors are packed into single integers to find the most frequent one
+    codes = np.zeros(cells.shape[:3], dtype='uint64')
+    for i in range(c):
+        codes |= cells[..., i].astype('uint64') << (8 * i)
+    codes.sort(axis=2)
+    
+    # length of the run of equal codes up to each position of the sorted samples
+    pos = np.arange(codes.shape[2])
+    new_run = np.ones(codes.shape, dtype=bool)
+    new_run[..., 1:] = codes[..., 1:] != codes[..., :-1]
+    run_len = pos - np.maximum.accumulate(np.where(new_run, pos, 0), axis=2)
+    code = np.take_along_axis(codes, np.argmax(run_len, axis=2)[..., None], axis=2)[..., 0]
+    
+    out = np.empty((ny, nx, c), dtype='uint8')
+    for i in range(c):
+        out[..., i] = (code >> (8 * i)) & 255
+    return out
+
+def _cellBounds(n, conv, offset, direction) -> (np.ndarray, np.ndarray):
+    # range of the pixels that lie fully inside each cell of the original image.
+    # cells thinner than a pixel or outside of the image fall back to the nearest pixel of their center.
+    pixsize = n / conv
+    if direction:
+        conv += 1
+    origin = -offset - (pixsize if direction < 0 else 0)
+    bounds = origin + pixsize * np.arange(conv + 1)
+    
+    start = np.clip(np.ceil(bounds[:-1] - 1e-6), 0, n).astype('int64')
+    end = np.clip(np.floor(bounds[1:] + 1e-6), 0, n).astype('int64')
+    center = np.clip(np.floor((bounds[:-1] + bounds[1:]) / 2), 0, n - 1).astype('int64')
+    
+    empty = end <= start
+    start[empty] = center[empty]
+    end[empty] = center[empty] + 1
+    return start, end
+
+def _cellSums(img: np.ndarray, start, end) -> np.ndarray:
+    # sums of the rows [start, end) of each cell, cells may leave gaps or overlap on the border
+    cuts = np.unique(np.concatenate((start, end)))
+    parts = np.add.reduceat(img[:cuts[-1]], cuts[:-1], axis=0, dtype='int64')
+    parts = np.concatenate((np.zeros((1,) + parts.shape[1:], dtype='int64'), np.cumsum(parts, axis=0)))
+    return parts[np.searchsorted(cuts, end)] - parts[np.searchsorted(cuts, start)]
+
+def _sampleCount(start, end) -> int:
+    # samples per cell, as many as the largest cell has pixels
+    return max(int(np.max(end - start)), 1)
+
+def _cellSamples(start, end, k) -> np.ndarray:
+    # k evenly spread sample positions for every cell
+    return start[:, None] + (np.arange(k)[None, :] * (end - start)[:, None]) // k
+
+def _detect(img: np.ndarray, mul=4, nr_sigma=0.0, detector='projection', band=0, report=None, workspace=None) -> (int, int, float, float, float):
+    # returns FFT size, offsets in original image pixels and the confidence of the weaker axis
+    h, w = img.shape[:2]
+    if detector == 'sampled':
+        # the halves are independent samples, the full pass only helps when they disagree
+        lines_x, lines_y = _sampledLines(img, mul, nr_sigma, SAMPLED_LINES, report)
+        with _timed(report, 'fft'):
+            conv_x, phase_x, _, confidence_x = _projectionFFT(lines_x, w, mul)
+            conv_y, phase_y, _, confidence_y = _projectionFFT(lines_y, h, mul)
+        agree = conv_x[2] and conv_y[2] and len(set(conv_x)) == 1 and len(set(conv_y)) == 1
+        if report is not None:
+            report['detection'] = 'sampled' if agree else 'full'
+        if agree:
+            _log('Sampled detection')
+            # same arithmetic as _detectPeaks
+            offset_x = w / int(conv_x[2]) * phase_x[2] / 360 - _centerShift(mul)
+            offset_y = h / int(conv_y[2]) * phase_y[2] / 360 - _centerShift(mul)
+            return int(conv_x[2]), int(conv_y[2]), offset_x, offset_y, min(float(confidence_x[2]), float(confidence_y[2]))
+        _log(f'Sampled FFT sizes {conv_x[0]}/{conv_x[1]}x{conv_y[0]}/{conv_y[1]} disagree, full pass')
+    
+    line_x, line_y = _detectLines(img, mul, nr_sigma, detector, band, report, workspace)
+    return _detectPeaks(line_x, line_y, w, h, mul, detector, report)
+
+def _detectTile(img: np.ndarray, x, y, w, h, mul=4, nr_sigma=0.0) -> (int, int, float, float, float, float, float):
+    # returns FFT size, refined pixel size, offsets in tile pixels and confidence of the weaker axis
+    line_x, line_y = _projectionLines(img[y:y+h, x:x+w], mul, nr_sigma)
+    conv_x, phase_x, freq_x, confidence_x = _projectionFFT(line_x, w, mul)
+    conv_y, phase_y, freq_y, confidence_y = _projectionFFT(line_y, h, mul)
+    
+    shift = _centerShift(mul)
+    offset_x = w / conv_x * phase_x / 360 - shift if conv_x else 0.0
+    offset_y = h / conv_y * phase_y / 360 - shift if conv_y else 0.0
+    pixel_x = w / freq_x if freq_x else 0.0
+    pixel_y = h / freq_y if freq_y else 0.0
+    return conv_x, conv_y, pixel_x, pixel_y, offset_x, offset_y, min(confidence_x, confidence_y)
+
+def _detectLines(img: np.ndarray, mul=4, nr_sigma=0.0, detector='projection', band=0, report=None, workspace=None) -> (np.ndarray, np.ndarray):
+    if detector == 'upscale':
+        return _upscaleLines(img, mul, nr_sigma, report, workspace)
+    return _projectionLines(img, mul, nr_sigma, band, report, workspace)
+
+def _detectPeaks(line_x: np.ndarray, line_y: np.ndarray, w: int, h: int, mul=4, detector='projection', report=None) -> (int, int, float, float, float):
+    if detector == 'upscale':
+        with _timed(report, 'fft'):
+            conv_x, phase_x, confidence_x = _upscaleFFT(line_x, mul)
+            conv_y, phase_y, confidence_y = _upscaleFFT(line_y, mul)
+        
+        # phase reference is the upscaled pixel grid
+        offset_x = w / conv_x * phase_x / 360 if conv_x else 0.0
+        offset_y = h / conv_y * phase_y / 360 if conv_y else 0.0
+        
+    else:
+        with _timed(report, 'fft'):
+            conv_x, phase_x, _, confidence_x = _projectionFFT(line_x, w, mul)
+            conv_y, phase_y, _, confidence_y = _projectionFFT(line_y, h, mul)
+        
+        # match the pixel center shift of the mul pre zoom
+        offset_x = w / conv_x * phase_x / 360 - _centerShift(mul) if conv_x else 0.0
+        offset_y = h / conv_y * phase_y / 360 - _centerShift(mul) if conv_y else 0.0
+    
+    return conv_x, conv_y, offset_x, offset_y, min(confidence_x, confidence_y)
+
+def _centerShift(mul: int) -> float:
+    # pixel center shift of the mul pre zoom, in original pixels
+    return (mul - 1) / (2 * mul)
+
+def _autoMul(w: int, h: int, conv_x: int, conv_y: int, reduction='upscale', band=0) -> int:
+    # smallest of AUTO_MULS that gives the upscale reconstruction pre zoomed pixels of at least AUTO_PIXSIZE
+    if reduction != 'upscale' or band or not conv_x or not conv_y:
+        return AUTO_MULS[0]
+    for mul in AUTO_MULS:
+        if min(w/conv_x, h/conv_y) * mul >= AUTO_PIXSIZE:
+            return mul
+    return AUTO_MULS[-1]
+
+def _upscaleLines(img: np.ndarray, mul=4, nr_sigma=0.0, report=None, workspace=None) -> (np.ndarray, np.ndarray):
+    with _timed(report, 'upscale'):
+        img = _upscale(img, mul, workspace)
+    _buffer(report, img)
+    
+    with _timed(report, 'gray'):
+        gray = _gray(img, workspace)
+    if nr_sigma > 0:
+        with _timed(report, 'blur'):
+            gray = cv2.GaussianBlur(gray, (0, 0), nr_sigma, _scratch(workspace, 'blur', gray.shape), borderType=cv2.BORDER_REPLICATE)
+    
+    return _scharrLines(gray, report, workspace)
+
+def _scharrLines(gray: np.ndarray, report=None, workspace=None) -> (np.ndarray, np.ndarray):
+    with _timed(report, 'scharr'):
+        edges_x = cv2.Scharr(gray, -1, 1, 0, _scratch(workspace, 'edges_x', gray.shape))
+        edges_y = cv2.Scharr(gray, -1, 0, 1, _scratch(workspace, 'edges_y', gray.shape))
+    
+    with _timed(report, 'projection'):
+        line_x = np.mean(edges_x, axis=0)
+        line_x = np.log(line_x+1)
+        
+        line_y = np.mean(edges_y, axis=1)
+        line_y = np.log(line_y+1)
+    
+    return line_x, line_y
+
+def _upscaleFFT(line: np.ndarray, mul=4) -> (int, float, float):
+    line = line - np.mean(line)
+    n = len(line)
+    
+    complex = np.fft.fft(line)[:n // 2]
+    mag = np.abs(complex)
+    mag /= n
+    phase = np.rad2deg(np.angle(complex))
+    
+    start = int(max(n/mul/50, 4)) # down to 1/50 scale OR at least 4x4 converted size
+    index = np.argmax(mag[start:]) + start
+    phase = phase[index]
+    confidence = _peakConfidence(mag[start:], index - start, 1, start)
+    
+    return index, phase, confidence
+
+def _projectionLines(img: np.ndarray, mul=4, nr_sigma=0.0, band=0, report=None, workspace=None) -> (np.ndarray, np.ndarray):
+    # band > 0 only holds that many rows plus the blur and edge halo at a time
+    h, w = img.shape[:2]
+    band = band or h
+    
+    sigma = nr_sigma / mul # nr_sigma is given in pre zoomed pixels
+    halo = 1 + (int(round(sigma*3*2 + 1)) | 1) // 2 if nr_sigma > 0 else 1 # uint8 Gaussian kernel radius
+    
+    sum_x = np.zeros(max(w-1, 0), dtype='float64')
+    line_y = np.zeros(max(h-1, 0), dtype='float32')
+    
+    for y0 in range(0, h, band):
+        y1 = min(y0 + band, h)
+        r0, r1 = max(y0 - halo, 0), min(y1 + halo, h)
+        
+        with _timed(report, 'gray'):
+            gray = _gray(np.ascontiguousarray(img[r0:r1]), workspace)
+        if nr_sigma > 0:
+            with _timed(report, 'blur'):
+                gray = cv2.GaussianBlur(gray, (0, 0), sigma, _scratch(workspace, 'blur', gray.shape), borderType=cv2.BORDER_REPLICATE)
+        
+        with _timed(report, 'projection'):
+            gray_f = _scratch(workspace, 'gray_f', gray.shape, 'float32')
+            np.copyto(gray_f, gray)
+            _buffer(report, gray_f)
             
-            if oxi > 0:
-                for i in range(oxi):
-                    img[:, i] = img[:, oxi]
-            else:
-                for i in range(-oxi):
-                    img[:, w-1-i] = img[:, w-1-(-oxi)]
+            # forward differences, sample i lies on the border between pixel i and i+1.
+            # negative edges are dropped like the uint8 Scharr output of the upscale engine.
+            rows = gray_f[y0-r0:y1-r0]
+            diff = np.subtract(rows[:, 1:], rows[:, :-1], out=_scratch(workspace, 'diff', (len(rows), w-1), 'float32'))
+            sum_x += np.sum(np.maximum(diff, 0, out=diff), axis=0)
             
-            if oyi > 0:
-                for i in range(oyi):
-                    img[i, :] = img[oyi, :]
-            else:
-                for i in range(-oyi):
-                    img[h-1-i, :] = img[h-1-(-oyi), :]
+            rows = gray_f[y0-r0:min(y1, h-1)-r0+1]
+            diff = np.subtract(rows[1:], rows[:-1], out=_scratch(workspace, 'diff', (len(rows)-1, w), 'float32'))
+            line_y[y0:min(y1, h-1)] = np.mean(np.maximum(diff, 0, out=diff), axis=1)
     
-    print(f'Final: {conv_x}x{conv_y}')
+    line_x = np.log(sum_x/h + 1)
+    line_y = np.log(line_y + 1)
     
-    # apply offset
-    oxi, oyi = int(offset_x), int(offset_y)
-    matrix = np.array([[1, 0, oxi], [0, 1, oyi]], dtype='float')
-    img = cv2.warpAffine(img, matrix, (w, h), borderMode=cv2.BORDER_REPLICATE)
+    return line_x, line_y
+
+def _sampledLines(img: np.ndarray, mul=4, nr_sigma=0.0, lines=SAMPLED_LINES, report=None) -> (np.ndarray, np.ndarray):
+    # _projectionLines on evenly spaced rows and columns only, the blur runs along the lines.
+    # returns (3, n-1) stacks of the even lines, the odd lines and all of them
+    h, w = img.shape[:2]
+    ys = np.unique(np.linspace(0, h - 1, min(lines, h)).round().astype('int64'))
+    xs = np.unique(np.linspace(0, w - 1, min(lines, w)).round().astype('int64'))
     
-    # shrink image
-    img = cv2.resize(img, (conv_x, conv_y), cv2.INTER_AREA)
+    with _timed(report, 'gray'):
+        rows = _gray(np.ascontiguousarray(img[ys]))
+        cols = _gray(np.ascontiguousarray(img[:, xs]))
+    if nr_sigma > 0:
+        with _timed(report, 'blur'):
+            sigma = nr_sigma / mul
+            kernel = cv2.getGaussianKernel(int(round(sigma*3*2 + 1)) | 1, sigma)
+            rows = cv2.sepFilter2D(rows, -1, kernel, np.ones((1, 1)), borderType=cv2.BORDER_REPLICATE)
+            cols = cv2.sepFilter2D(cols, -1, np.ones((1, 1)), kernel, borderType=cv2.BORDER_REPLICATE)
+    
+    with _timed(report, 'projection'):
+        edges_x = np.maximum(np.diff(rows.astype('float32'), axis=1), 0)
+        edges_y = np.maximum(np.diff(cols.astype('float32'), axis=0), 0)
+        odd = min(1, len(ys) - 1), min(1, len(xs) - 1) # a single line is both halves
+        lines_x = np.stack([np.mean(edges_x[0::2], axis=0), np.mean(edges_x[odd[0]::2], axis=0), np.mean(edges_x, axis=0)])
+        lines_y = np.stack([np.mean(edges_y[:, 0::2], axis=1), np.mean(edges_y[:, odd[1]::2], axis=1), np.mean(edges_y, axis=1)])
+    
+    return np.log(lines_x + 1), np.log(lines_y + 1)
+
+def _projectionStack(imgs: np.ndarray, mul=4, nr_sigma=0.0, report=None) -> (np.ndarray, np.ndarray):
+    # _projectionLines of every image of an (N, H, W, ...) stack, as (N, W-1) and (N, H-1) arrays
+    n, h, w = imgs.shape[:3]
+    
+    with _timed(report, 'gray'):
+        # the images are laid out as one tall image for the color conversion
+        gray = np.ascontiguousarray(imgs)
+        gray = _gray(gray.reshape(n*h, w, -1) if gray.ndim == 4 else gray.reshape(n*h, w)).reshape(n, h, w)
+    if nr_sigma > 0:
+        with _timed(report, 'blur'):
+            gray = np.stack([cv2.GaussianBlur(img, (0, 0), nr_sigma / mul, borderType=cv2.BORDER_REPLICATE) for img in gray])
+    
+    with _timed(report, 'projection'):
+        gray = gray.astype('float32')
+        _buffer(report, gray)
+        sum_x = np.sum(np.maximum(np.diff(gray, axis=2), 0), axis=1).astype('float64')
+        line_y = np.mean(np.maximum(np.diff(gray, axis=1), 0), axis=2)
+    
+    return np.log(sum_x/h + 1), np.log(line_y + 1)
+
+def _gray(img: np.ndarray, workspace=None) -> np.ndarray:
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, _scratch(workspace, 'gray', img.shape[:2]))
+
+def _upscale(img: np.ndarray, mul, workspace=None) -> np.ndarray:
+    h, w = img.shape[:2]
+    return cv2.resize(img, (w*mul, h*mul), _scratch(workspace, 'upscale', (h*mul, w*mul) + img.shape[2:]), interpolation=cv2.INTER_LINEAR)
+
+def _scratch(workspace, name: str, shape: tuple, dtype='uint8') -> np.ndarray:
+    # buffer of the workspace, or a new array without one
+    return np.empty(shape, dtype=dtype) if workspace is None else workspace.get(name, shape, dtype)
+
+def _bgr(img: np.ndarray) -> np.ndarray:
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR) if img.shape[2] == 4 else img
+
+def _log(*args):
+    (getattr(_local, 'logger', None) or _logger)(' '.join(str(arg) for arg in args))
+
+@contextlib.contextmanager
+def _timed(report, stage):
+    # adds the seconds spent in the block to report['timings'][stage], stages called many times accumulate.
+    # stages: decode, hash, upscale, gray, blur, scharr, projection, fft, warp, resize, reduce, encode
+    if report is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _addTime(report, stage, start)
+
+def _addTime(report, stage, start):
+    if report is not None:
+        timings = report.setdefault('timings', {})
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def _addTimings(report, timings: dict):
+    # stage timings measured elsewhere, by worker processes or threads
+    if report is not None:
+        for stage, seconds in timings.items():
+            report.setdefault('timings', {})[stage] = report['timings'].get(stage, 0.0) + seconds
+
+def _buffer(report, img: np.ndarray):
+    # keeps the size of the largest intermediate buffer in report['peak_buffer'], in bytes
+    if report is not None:
+        report['peak_buffer'] = max(report.get('peak_buffer', 0), int(img.nbytes))
+
+def _projectionFFT(line: np.ndarray, n: int, mul=4) -> (int, float, float, float):
+    # n is the image length, the line is one sample shorter.
+    # line can also be an (N, n-1) stack of lines, the results are then arrays of length N.
+    lines = np.atleast_2d(line)
+    rows = np.arange(len(lines))
+    start = int(max(n/50, 4)) # same search range as the upscale engine
+    end = int(n / 2)
+    if n < 2 or start >= end:
+        zeros = np.zeros(len(lines))
+        return (0, 0.0, 0.0, 0.0) if line.ndim == 1 else (zeros.astype('int64'), zeros, zeros, zeros)
+    lines = lines - np.mean(lines, axis=1, keepdims=True)
+    
+    complex = np.fft.rfft(lines, n * FFT_PAD, axis=1) # bin i*FFT_PAD is the unpadded bin i
+    mag = np.abs(complex)
     
-    return True, img
+    # the pre zoom turns every edge into a 1px wide ramp, its response damps the harmonics
+    mag *= np.sinc(np.arange(mag.shape[1]) / (n * FFT_PAD))
+    
+    peak = np.argmax(mag[:, start*FFT_PAD:end*FFT_PAD], axis=1)
+    index = peak + start*FFT_PAD
+    confidence = _peakConfidence(mag[:, start*FFT_PAD:end*FFT_PAD], peak, FFT_PAD, start*FFT_PAD)
+    
+    # parabolic peak refinement, in the precision of the spectrum
+    inner = (index > 0) & (index < mag.shape[1] - 1)
+    a = mag[rows, np.maximum(index-1, 0)]
+    b = mag[rows, index]
+    c = mag[rows, np.minimum(index+1, mag.shape[1]-1)]
+    denom = a - 2*b + c
+    refine = inner & (denom != 0)
+    delta = 0.5 * (a - c) / np.where(refine, denom, 1)
+    freq = np.where(refine, index.astype(delta.dtype) + delta, index) / FFT_PAD
+    
+    conv = np.clip(np.round(freq), 1, end).astype('int64')
+    
+    # phase of the exact bin, moved half a pixel back to the sample positions
+    phase = np.angle(complex[rows, conv*FFT_PAD])
+    phase = phase - (np.pi * conv / n).astype(phase.dtype)
+    phase = np.rad2deg((phase + np.pi) % (2*np.pi) - np.pi)
+    
+    if line.ndim == 1:
+        return int(conv[0]), phase[0], float(freq[0]), float(confidence[0])
+    return conv, phase, freq, confidence
+
+def _peakConfidence(mag: np.ndarray, index, width: int, offset=0):
+    # peak to second peak ratio. the edges are a pulse train, so the lobes of the peak and its harmonics are excluded,
+    # their width grows by half a bin per harmonic for the error of the peak position. offset is the bin of mag[0].
+    # mag can also be an (N, L) stack with N indices, the result is then an array. 0 without any peak.
+    mags = np.atleast_2d(mag)
+    indices = np.atleast_1d(index)
+    bins = np.arange(mags.shape[1])[None, :] + offset
+    peak_bins = np.maximum(indices[:, None] + offset, 1)
+    harmonic = np.maximum(np.round(bins / peak_bins), 1)
+    lobe = np.abs(bins - harmonic * peak_bins) <= width + 0.5 * harmonic
+    others = np.max(np.where(lobe, 0, mags), axis=1) # magnitudes are never negative
+    peaks = mags[np.arange(len(mags)), indices]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = np.where(others > 0, np.minimum(peaks / np.where(others > 0, others, 1), MAX_CONFIDENCE), MAX_CONFIDENCE)
+    confidence = np.where(peaks > 0, confidence, 0.0)
+    return float(confidence[0]) if mag.ndim == 1 else confidence
 
 def main(args = sys.argv[1:]):
-    print('RePixelator', __version__, 'by yclee126')
-    print('Usage: in_file out_file [nZoom [fNoise [fEdge_thr]]]')
-    print('Example: in.png out.png 4 0 0.8\n')
+    if args and args[0] in COMMANDS:
+        return subcommand(args[0]).main(args[1:])
+    
+    # --json prints the report as one JSON line, the messages go to stderr
+    json_lines = '--json' in args
+    if json_lines:
+        args = [arg for arg in args if arg != '--json']
+        setLogger(lambda message: print(message, file=sys.stderr))
+    
+    _log('RePixelator', __version__, 'by yclee126')
+    _log(USAGE)
+    
+    ret = False
+    report = {}
+    if args and args[0] == 'detect':
+        if len(args) > 2 and detectGridFile(*args[1:], report=report):
+            ret = True
+            _log('\nProfile saved')
+    elif args and args[0] == 'apply':
+        params = dict(zip(('edge_threshold', 'reduction'), args[4:6]))
+        if len(args) > 3 and rePixelateFile(args[1], args[2], profile=args[3], report=report, **params):
+            ret = True
+            _log('\nFile converted')
+    elif args and rePixelateFile(*args, report=report):
+        ret = True
+        _log('\nFile converted')
     
-    if args and rePixelateFile(*args):
-        print('\nFile converted')
+    if json_lines and args:
+        print(json.dumps({'args': args, 'ok': ret, 'report': report}))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
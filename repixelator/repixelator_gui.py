@@ -1,5 +1,5 @@
 # GUI for RePixelator v1.0.1
-# Works on python 3.4 or higher
+# Works on python 3.9 or higher
 
 try:
     import wx
@@ -9,16 +9,22 @@ except:
     exit()
 
 try:
-    from .repixelator import rePixelateFile
+    from .repixelator import detectGridFile
+    from .repixelator import GridProfile
+    from .repixelator import GridPreview, _readFile
+    from .repixelator import REDUCTIONS
     from .repixelator import __version__
+    from .batch import _initWorker, _convertOne
 except:
     wx.LogFatalError('repixelator.py file not found or corrupt. Please place the file within the same directory.')
 
-from threading import Thread
+from threading import Thread, Event, Lock
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import freeze_support
 from pathlib import Path
 import os
 import sys
-import numpy as np
+import time
 
 if os.name == 'nt':
     import ctypes
@@ -27,18 +33,155 @@ if os.name == 'nt':
 
 
 class RedirectStdoutToTextCtrl():
+    # writes from any thread are collected and written to the widget by the GUI timer, one call per flush
     def __init__(self, widget):
         sys.stdout = self
         self.widget = widget
+        self.messages = []
+        self.lock = Lock()
     
     def write(self, message):
-        self.widget.WriteText(message)
+        with self.lock:
+            self.messages.append(message)
         return len(message)
     
+    def flush(self):
+        pass
+    
+    def flushWidget(self):
+        # GUI thread only
+        with self.lock:
+            message = ''.join(self.messages)
+            self.messages = []
+        if message:
+            self.widget.WriteText(message)
+    
     def __del__(self):
         sys.stdout = sys.__stdout__
 
 
+FLUSH_INTERVAL = 100 # ms between log and progress updates
+PREVIEW_SIZE = 320 # px, longer side of the preview images
+PREVIEW_DELAY = 150 # ms without setting changes before the preview is updated
+
+
+class PreviewFrame(wx.Frame):
+    # grid overlay and result of one file, computed in a background thread when the settings change.
+    # GridPreview keeps the intermediate stages, so most changes only redo the last steps.
+    def __init__(self, gui):
+        wx.Frame.__init__(self, gui, wx.ID_ANY, 'Preview')
+        self.gui = gui
+        self.preview = None
+        self.busy = False
+        self.dirty = False
+        self.delay = None
+        
+        panel = wx.Panel(self)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        panel.SetSizer(sizer)
+        
+        topSizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(topSizer, flag=wx.EXPAND)
+        
+        openButton = wx.Button(panel, label='Open', style=wx.BU_EXACTFIT)
+        topSizer.Add(openButton, flag=wx.ALL, border=5)
+        openButton.Bind(wx.EVT_BUTTON, self.onOpenFile)
+        
+        self.fileLabel = wx.StaticText(panel, label='Drop a file here')
+        topSizer.Add(self.fileLabel, flag=wx.ALIGN_CENTER_VERTICAL, proportion=1)
+        
+        imageSizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(imageSizer)
+        
+        self.overlayBitmap = wx.StaticBitmap(panel, size=(PREVIEW_SIZE, PREVIEW_SIZE))
+        imageSizer.Add(self.overlayBitmap, flag=wx.ALL, border=5)
+        
+        self.resultBitmap = wx.StaticBitmap(panel, size=(PREVIEW_SIZE, PREVIEW_SIZE))
+        imageSizer.Add(self.resultBitmap, flag=wx.ALL^wx.LEFT, border=5)
+        
+        self.statusLabel = wx.StaticText(panel, label='')
+        sizer.Add(self.statusLabel, flag=wx.LEFT|wx.RIGHT|wx.BOTTOM|wx.EXPAND, border=5)
+        
+        panel.SetDropTarget(GUI.FileDrop(self.openFile))
+        sizer.SetSizeHints(self)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
+    
+    def onOpenFile(self, evt):
+        with wx.FileDialog(self, "Open image file to preview", wildcard="All files|*.*", style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
+            if fileDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            self.openFile([fileDialog.GetPath()])
+    
+    def openFile(self, files):
+        # the first frame of animations is previewed
+        ret, img, cap = _readFile(files[0])
+        if cap is not None:
+            ret, img = cap.read()
+            cap.release()
+        if not ret or img is None or img.ndim < 2:
+            self.statusLabel.SetLabel('File read error')
+            return
+        
+        self.preview = GridPreview(img)
+        self.fileLabel.SetLabel(Path(files[0]).name)
+        self.schedule()
+    
+    def schedule(self):
+        # slider drags restart the delay, the preview follows once they pause
+        if self.preview is None:
+            return
+        if self.delay is not None and self.delay.IsRunning():
+            self.delay.Start(PREVIEW_DELAY)
+        else:
+            self.delay = wx.CallLater(PREVIEW_DELAY, self.update)
+    
+    def update(self):
+        params = self.gui.getParams()
+        if params is None:
+            self.statusLabel.SetLabel('Invalid offset pixel threshold')
+            return
+        if self.busy: # runs again when the current update ends
+            self.dirty = True
+            return
+        self.busy = True
+        Thread(target=self.previewThread, daemon=True, args=(self.preview, params)).start()
+    
+    def previewThread(self, preview, params):
+        report = {}
+        start = time.perf_counter()
+        try:
+            ret, _ = preview.update(report=report, **params)
+            overlay, result = preview.overlay(PREVIEW_SIZE), preview.result(PREVIEW_SIZE)
+            message = preview.log[-1] if preview.log else ''
+        except Exception as e:
+            ret, overlay, result, message = False, None, None, f'Unknown error: {e}'
+        elapsed = time.perf_counter() - start
+        wx.CallAfter(self.showPreview, ret, overlay, result, message, report.get('stages', []), elapsed)
+    
+    def showPreview(self, ret, overlay, result, message, stages, elapsed):
+        self.busy = False
+        if not self: # closed meanwhile
+            return
+        if overlay is not None:
+            self.overlayBitmap.SetBitmap(self.toBitmap(overlay))
+        self.resultBitmap.SetBitmap(self.toBitmap(result) if ret and result is not None else wx.NullBitmap)
+        self.statusLabel.SetLabel(f"{message}  ({elapsed*1000:.0f}ms, {', '.join(stages) or 'cached'})" if ret else message or 'No grid detected')
+        
+        if self.dirty:
+            self.dirty = False
+            self.update()
+    
+    def toBitmap(self, img):
+        h, w = img.shape[:2]
+        return wx.Bitmap.FromBuffer(w, h, img[..., ::-1].tobytes()) # BGR to RGB
+    
+    def onClose(self, evt):
+        if self.delay is not None:
+            self.delay.Stop()
+        self.gui.previewFrame = None
+        evt.Skip()
+
+
 class GUI(wx.Frame):
     def __init__(self, parent, id, title):
         wx.Frame.__init__(self, parent, id, title)
@@ -71,15 +214,27 @@ class GUI(wx.Frame):
         self.Centre()
         self.panel.Layout()
         
+        # conversion state, written by the worker thread and shown by the timer
+        self.executor = None
+        self.executorJobs = 0
+        self.stopEvent = Event()
+        self.progress = None
+        self.progressShown = None
+        self.previewFrame = None
+        
+        self.flushTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onFlush, self.flushTimer)
+        self.flushTimer.Start(FLUSH_INTERVAL)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
+        
     def mainUI(self, panel):
         sizer = wx.BoxSizer(wx.VERTICAL)
         panel.SetSizer(sizer)
         
-        # TODO: Stop button
         self.dndButton = wx.Button(panel, label='Drop files here\nor click to select files', size=(222, 100))
         sizer.Add(self.dndButton, flag=wx.ALL, border=5, proportion=1)
         self.dndButton.Bind(wx.EVT_BUTTON, self.onOpenFiles)
-        self.dndButton.SetDropTarget(self.FileDrop(self))
+        self.dndButton.SetDropTarget(self.FileDrop(self.startConvert))
         
         self.gauge = wx.Gauge(panel, range=1000, style=wx.GA_HORIZONTAL, size=(0, 20))
         sizer.Add(self.gauge, flag=wx.LEFT|wx.RIGHT|wx.EXPAND, border=5)
@@ -96,6 +251,15 @@ class GUI(wx.Frame):
         bottomSizer.Add(logsButton, flag=wx.UP|wx.DOWN, border=5)
         logsButton.Bind(wx.EVT_BUTTON, lambda _: self.toggleFrames('l'))
         
+        previewButton = wx.Button(panel, label='Preview', style=wx.BU_EXACTFIT)
+        bottomSizer.Add(previewButton, flag=wx.LEFT|wx.UP|wx.DOWN, border=5)
+        previewButton.Bind(wx.EVT_BUTTON, self.showPreviewFrame)
+        
+        self.stopButton = wx.Button(panel, label='Stop', style=wx.BU_EXACTFIT)
+        bottomSizer.Add(self.stopButton, flag=wx.ALL, border=5)
+        self.stopButton.Bind(wx.EVT_BUTTON, self.onStop)
+        self.stopButton.Enable(False)
+        
         self.statusLabel = wx.StaticText(panel, label='0%', style=wx.ALIGN_CENTRE_HORIZONTAL)
         bottomSizer.Add(self.statusLabel, flag=wx.ALIGN_CENTER, proportion=1)
         
@@ -115,9 +279,9 @@ class GUI(wx.Frame):
         mulLabel = wx.StaticText(panel, label='Image pre zoom: x4')
         sizer.Add(mulLabel, flag=wx.ALL|wx.EXPAND, border=5)
         
-        mulSlider = wx.Slider(panel, value=4, minValue=1, maxValue=4, style=wx.SL_AUTOTICKS)
+        mulSlider = wx.Slider(panel, value=4, minValue=0, maxValue=4, style=wx.SL_AUTOTICKS) # 0 is auto
         sizer.Add(mulSlider, flag=wx.EXPAND)
-        mulSlider.Bind(wx.EVT_SCROLL, lambda _: mulLabel.SetLabel(mulLabel.GetLabel()[:-1]+str(mulSlider.GetValue())))
+        mulSlider.Bind(wx.EVT_SCROLL, lambda _: mulLabel.SetLabel('Image pre zoom: ' + (f'x{mulSlider.GetValue()}' if mulSlider.GetValue() else 'auto')))
         
         #
         sizer.Add(wx.StaticLine(panel, wx.LI_HORIZONTAL), flag=wx.EXPAND)
@@ -160,6 +324,45 @@ class GUI(wx.Frame):
         sizer.Add(wx.StaticLine(panel, wx.LI_HORIZONTAL), flag=wx.EXPAND)
         #
         
+        # reconstruction setting
+        rcSizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(rcSizer, flag=wx.EXPAND|wx.ALL, border=5)
+        
+        rcText = wx.StaticText(panel, label='Reconstruction:')
+        rcSizer.Add(rcText, flag=wx.ALIGN_CENTER_VERTICAL)
+        
+        rcChoice = wx.Choice(panel, choices=list(REDUCTIONS))
+        rcSizer.Add(rcChoice, flag=wx.LEFT, border=5, proportion=1)
+        rcChoice.SetSelection(0)
+        
+        #
+        sizer.Add(wx.StaticLine(panel, wx.LI_HORIZONTAL), flag=wx.EXPAND)
+        #
+        
+        # grid profile setting
+        self.profile = None
+        self.profileLabel = wx.StaticText(panel, label='Grid profile: detect')
+        sizer.Add(self.profileLabel, flag=wx.ALL|wx.EXPAND, border=5)
+        
+        pfSizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(pfSizer, flag=wx.LEFT|wx.RIGHT|wx.BOTTOM|wx.EXPAND, border=5)
+        
+        pfSaveButton = wx.Button(panel, label='Save', style=wx.BU_EXACTFIT)
+        pfSizer.Add(pfSaveButton, proportion=1)
+        pfSaveButton.Bind(wx.EVT_BUTTON, self.onSaveProfile)
+        
+        pfLoadButton = wx.Button(panel, label='Load', style=wx.BU_EXACTFIT)
+        pfSizer.Add(pfLoadButton, flag=wx.LEFT|wx.RIGHT, border=5, proportion=1)
+        pfLoadButton.Bind(wx.EVT_BUTTON, self.onLoadProfile)
+        
+        pfClearButton = wx.Button(panel, label='Clear', style=wx.BU_EXACTFIT)
+        pfSizer.Add(pfClearButton, proportion=1)
+        pfClearButton.Bind(wx.EVT_BUTTON, lambda _: self.setProfile(None))
+        
+        #
+        sizer.Add(wx.StaticLine(panel, wx.LI_HORIZONTAL), flag=wx.EXPAND)
+        #
+        
         fsLabel = wx.StaticText(panel, label='File save path')
         sizer.Add(fsLabel, flag=wx.ALL|wx.ALIGN_LEFT, border=5)
         
@@ -179,7 +382,40 @@ class GUI(wx.Frame):
         outEntry = wx.TextCtrl(panel, value='%s_converted.png', size=(100, 25))
         sizer.Add(outEntry, flag=wx.ALL|wx.EXPAND, border=5)
         
-        self.settings = [mulSlider, nrSlider, opEntry, fsRadioButton, outEntry]
+        #
+        sizer.Add(wx.StaticLine(panel, wx.LI_HORIZONTAL), flag=wx.EXPAND)
+        #
+        
+        # parallel conversion setting
+        jbSizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(jbSizer, flag=wx.EXPAND|wx.ALL, border=5)
+        
+        jbText = wx.StaticText(panel, label='Parallel jobs:')
+        jbSizer.Add(jbText, flag=wx.ALIGN_CENTER_VERTICAL)
+        
+        cpus = os.cpu_count() or 1
+        jbSpin = wx.SpinCtrl(panel, value=str(cpus), min=1, max=cpus*2, size=(60, 25))
+        jbSizer.Add(jbSpin, flag=wx.LEFT, border=5)
+        
+        self.settings = [mulSlider, nrSlider, opEntry, fsRadioButton, outEntry, rcChoice, jbSpin]
+        
+        # the preview follows the conversion settings, the handlers above still run
+        for widget, event in ((mulSlider, wx.EVT_SCROLL), (nrSlider, wx.EVT_SCROLL), (opEntry, wx.EVT_TEXT), (rcChoice, wx.EVT_CHOICE)):
+            widget.Bind(event, self.onSettingChange)
+    
+    def onSettingChange(self, evt):
+        evt.Skip()
+        if self.previewFrame is not None:
+            self.previewFrame.schedule()
+    
+    def getParams(self):
+        # conversion parameters of the settings, None if the offset pixel threshold isn't a number
+        try:
+            op_value = float(self.settings[2].GetValue())
+        except:
+            return None
+        return {'mul': self.settings[0].GetValue() or 'auto', 'nr_sigma': self.settings[1].GetValue() / 2, 'edge_threshold': op_value,
+                'reduction': self.settings[5].GetStringSelection(), 'profile': self.profile}
     
     def logsUI(self, panel):
         sizer = wx.BoxSizer(wx.VERTICAL)
@@ -188,7 +424,7 @@ class GUI(wx.Frame):
         self.logsTextCtrl = wx.TextCtrl(panel, style=wx.TE_MULTILINE|wx.TE_READONLY, size=(222, 0))
         sizer.Add(self.logsTextCtrl, flag=wx.ALL|wx.EXPAND, border=5, proportion=1)
         self.logsTextCtrl.WriteText('Right click to clear the logs.\n\n')
-        RedirectStdoutToTextCtrl(self.logsTextCtrl)
+        self.stdout = RedirectStdoutToTextCtrl(self.logsTextCtrl)
         
         def onContextMenu(evt):
             menu = wx.Menu()
@@ -236,6 +472,51 @@ class GUI(wx.Frame):
             files = fileDialog.GetPaths()
             self.startConvert(files)
     
+    def onSaveProfile(self, evt):
+        with wx.FileDialog(self, "Open image file to detect the grid", wildcard="All files|*.*", style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
+            if fileDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            in_file = fileDialog.GetPath()
+        
+        with wx.FileDialog(self, "Save grid profile", wildcard="Grid profile|*.json", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
+            if fileDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            profile_file = fileDialog.GetPath()
+        
+        mul_value = self.settings[0].GetValue() or 'auto'
+        nr_value = self.settings[1].GetValue() / 2
+        rc_value = self.settings[5].GetStringSelection()
+        if detectGridFile(in_file, profile_file, mul_value, nr_value, reduction=rc_value):
+            print('\nProfile saved')
+            self.setProfile(GridProfile.load(profile_file), profile_file)
+        else:
+            wx.MessageDialog(self, 'No grid detected. Please check the log.', 'Error', wx.OK|wx.ICON_ERROR).ShowModal()
+    
+    def onLoadProfile(self, evt):
+        with wx.FileDialog(self, "Load grid profile", wildcard="Grid profile|*.json|All files|*.*", style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
+            if fileDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            profile_file = fileDialog.GetPath()
+        
+        try:
+            self.setProfile(GridProfile.load(profile_file), profile_file)
+        except:
+            wx.MessageDialog(self, 'Invalid grid profile file', 'Error', wx.OK|wx.ICON_ERROR).ShowModal()
+    
+    def setProfile(self, profile, profile_file=''):
+        # loaded profile is applied to every file instead of the detection
+        self.profile = profile
+        self.profileLabel.SetLabel('Grid profile: ' + (Path(profile_file).name if profile else 'detect'))
+        self.panel.Layout()
+        if self.previewFrame is not None:
+            self.previewFrame.schedule()
+    
+    def showPreviewFrame(self, evt):
+        if self.previewFrame is None:
+            self.previewFrame = PreviewFrame(self)
+        self.previewFrame.Show(True)
+        self.previewFrame.Raise()
+    
     def showAboutFrame(self, evt):
         info = AboutDialogInfo()
         info.SetName('RePixelator')
@@ -246,86 +527,164 @@ class GUI(wx.Frame):
     
     def startConvert(self, files):
         # get parameters
-        mul_value = self.settings[0].GetValue()
-        nr_value = self.settings[1].GetValue() / 2
-        try:
-            op_value = float(self.settings[2].GetValue())
-        except:
+        params = self.getParams()
+        if params is None:
             wx.MessageDialog(self, 'Invalid character in number field', 'Error', wx.OK|wx.ICON_ERROR).ShowModal()
             return
 
         out_sel = self.settings[3].GetValue()
         out_string = self.settings[4].GetValue()
+        jobs = self.settings[6].GetValue()
         try:
             str(Path(out_string).stem) % ''
         except:
             wx.MessageDialog(self, 'Invalid output file name', 'Error', wx.OK|wx.ICON_ERROR).ShowModal()
             return
+        if self.progress is not None and self.progress['running']:
+            return
+        
+        self.dndButton.Enable(False)
+        self.settingsPanel.Enable(False)
+        self.stopButton.Enable(True)
+        self.stopEvent.clear()
+        self.progress = {'running': True, 'done': 0, 'total': len(files), 'start': time.perf_counter()}
         
         # start thread
-        Thread(target=self.workerThread, daemon=True, args=(files, mul_value, nr_value, op_value, out_sel, out_string)).start()
+        Thread(target=self.workerThread, daemon=True, args=(files, out_sel, out_string, params, self.getExecutor(jobs), jobs)).start()
     
-    def workerThread(self, files, mul_value, nr_value, op_value, out_sel, out_string):
-        wx.CallAfter(self.dndButton.Enable, False)
-        wx.CallAfter(self.settingsPanel.Enable, False)
-        wx.CallAfter(self.gauge.SetValue, 0)
-        wx.CallAfter(self.statusLabel.SetLabel, '0%')
-        wx.CallAfter(self.panel.Layout)
-        
+    def getExecutor(self, jobs):
+        # the worker processes stay alive between conversions
+        if self.executor is None or self.executorJobs != jobs:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.executor = ProcessPoolExecutor(jobs, initializer=_initWorker, initargs=(1 if jobs > 1 else None,))
+            self.executorJobs = jobs
+        return self.executor
+    
+    def workerThread(self, files, out_sel, out_string, params, executor, jobs):
         failed_files = []
+        pending = {}
+        queue = list(enumerate(files))[::-1]
         
-        for i, file in enumerate(files):
-            print(f'\nFile {i+1}/{len(files)}')
-            file_path = Path(file).resolve()
-            
-            if out_sel:
-                output_path = str(file_path.parent)
-            else:
-                output_path = str(Path().cwd())
-            
-            file_name = out_string % str(file_path.stem)
-            output_file = os.path.join(output_path, file_name)
-            
-            # process file
-            result = False
-            try:
-                result = rePixelateFile(file, output_file, mul_value, nr_value, op_value)
-            except:
-                print('Unknown error')
-            
-            if not result:
-                failed_files.append(file)
-            
-            wx.CallAfter(self.gauge.SetValue, int((i+1)/len(files)*1000))
-            wx.CallAfter(self.statusLabel.SetLabel, f'{int((i+1)/len(files)*100)}%')
-            wx.CallAfter(self.panel.Layout)
-        
+        try:
+            while queue or pending:
+                # keep a bounded number of files submitted, so stopping only waits for the running ones
+                while queue and len(pending) < jobs * 2 and not self.stopEvent.is_set():
+                    i, file = queue.pop()
+                    pending[executor.submit(_convertOne, file, self.outputFile(file, out_sel, out_string), params)] = file
+                if not pending:
+                    break
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file = pending.pop(future)
+                    if future.cancelled():
+                        continue
+                    self.progress['done'] += 1
+                    print(f"\nFile {self.progress['done']}/{len(files)}")
+                    try:
+                        result, log, _ = future.result()
+                        print(log, end='')
+                    except Exception as e: # worker crashed
+                        result = False
+                        print(file)
+                        print('Unknown error:', e)
+                    
+                    if not result:
+                        failed_files.append(file)
+                
+                if self.stopEvent.is_set():
+                    for future in pending:
+                        future.cancel()
+        except Exception as e: # the pool is broken, it is created again next time
+            print('Unknown error:', e)
+            failed_files += [file for _, file in queue] + list(pending.values())
+            self.executor = None
+        
+        skipped = len(files) - self.progress['done']
+        if skipped and self.stopEvent.is_set():
+            print(f'\nStopped, {skipped} file(s) skipped.')
         if failed_files:
             failMsg = f'\n{len(failed_files)} file(s) failed to process:'
             print(failMsg)
             for failed_file in failed_files:
                 print(failed_file)
-            wx.MessageDialog(self, 'An error has occurred. Please check the log.', 'Error', wx.OK|wx.ICON_ERROR).ShowModal()
-        else:
+            wx.CallAfter(self.showError, 'An error has occurred. Please check the log.')
+        elif not skipped:
             print('\nAll files converted.')
         
+        self.progress['running'] = False
         wx.CallAfter(self.dndButton.Enable, True)
         wx.CallAfter(self.settingsPanel.Enable, True)
-        wx.CallAfter(self.gauge.SetValue, 1000)
+        wx.CallAfter(self.stopButton.Enable, False)
+    
+    def outputFile(self, file, out_sel, out_string):
+        file_path = Path(file).resolve()
+        
+        if out_sel:
+            output_path = str(file_path.parent)
+        else:
+            output_path = str(Path().cwd())
+        
+        file_name = out_string % str(file_path.stem)
+        return os.path.join(output_path, file_name)
+    
+    def onStop(self, evt):
+        # running files finish, the rest is cancelled
+        self.stopEvent.set()
+        self.stopButton.Enable(False)
+        print('\nStopping...')
+    
+    def onFlush(self, evt):
+        # log and progress are shown at most once per timer tick
+        self.stdout.flushWidget()
         
+        progress = self.progress
+        if progress is None:
+            return
+        state = (progress['done'], progress['running'])
+        if state == self.progressShown:
+            return
+        self.progressShown = state
+        
+        done, total = progress['done'], progress['total']
+        elapsed = time.perf_counter() - progress['start']
+        rate = done / elapsed if elapsed > 0 else 0.0
+        self.gauge.SetValue(int(done / total * 1000) if total else 1000)
+        
+        label = f'{done}/{total}'
+        if progress['running'] and rate > 0:
+            eta = int((total - done) / rate)
+            label += f'  {rate:.1f}/s  ETA {eta//60}:{eta%60:02d}'
+        elif done:
+            label += f'  {rate:.1f}/s'
+        self.statusLabel.SetLabel(label)
+        self.panel.Layout()
+    
+    def showError(self, message):
+        wx.MessageDialog(self, message, 'Error', wx.OK|wx.ICON_ERROR).ShowModal()
+    
+    def onClose(self, evt):
+        self.stopEvent.set()
+        self.flushTimer.Stop()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        evt.Skip()
+    
     def getIcon(self):
         pass
     
     class FileDrop(wx.FileDropTarget):
-        def __init__(self, parent):
+        def __init__(self, callback):
             wx.FileDropTarget.__init__(self)
-            self.parent = parent
+            self.callback = callback
      
         def OnDropFiles(self, x, y, filenames):
-            self.parent.startConvert(filenames)
+            self.callback(filenames)
             return True
 
 def main():
+    freeze_support() # worker processes of frozen executables
     app = wx.App()
     gui = GUI(None, wx.ID_ANY, 'RePixelator')
     gui.Show(True)
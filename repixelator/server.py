@@ -0,0 +1,316 @@
+# Conversion server for RePixelator
+# Keeps a pool of warm worker processes and takes conversion jobs over localhost HTTP, see client.py.
+#
+#   GET  /health                   server status
+#   GET  /stats                    job counters and timings
+#   POST /convert                  JSON body {"in_file": ..., "out_file": ..., parameters}, files are read and written by the server
+#   POST /convert?parameters       raw image bytes, the response is the converted image (format=.png by default)
+#                                  and the X-RePixelator-Report header holds the JSON report
+
+import argparse
+import contextlib
+import io
+import ipaddress
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+from .repixelator import __version__
+from .batch import _initWorker, _convertOne, _workspace, gridCache
+
+
+DEFAULT_PORT = 8617
+
+# job parameters, all of them are passed to rePixelateFile as strings like the CLI arguments
+PARAMS = ('mul', 'nr_sigma', 'edge_threshold', 'detector', 'reduction', 'band', 'profile', 'animation', 'analysis_frames', 'analysis_step')
+PATH_PARAMS = ('profile',) # files read by the server, like the paths of file jobs
+FILE_PARAMS = ('animation', 'analysis_frames', 'analysis_step') # only for file jobs, uploads are converted as still images
+MAX_BODY = 256 << 20 # bytes, larger requests are rejected with 413 before reading them
+
+
+class ConversionServer():
+    # paths: accept file jobs and file parameters, which read and write any file the server can reach
+    # max_body: largest request body in bytes
+    def __init__(self, jobs=None, queue=None, cv_threads=1, cache=None, paths=True, max_body=MAX_BODY):
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.queue = self.jobs * 4 if queue is None else max(queue, 0)
+        self.cv_threads = cv_threads
+        self.cache = cache
+        self.paths = paths
+        self.max_body = max_body
+        
+        # jobs running or waiting for a worker, requests above this are rejected with 503
+        self.slots = threading.BoundedSemaphore(self.jobs + self.queue)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.start_time = time.time()
+        self.stats = {'completed': 0, 'failed': 0, 'rejected': 0, 'errors': 0, 'active': 0, 'seconds': 0.0}
+    
+    def start(self):
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=_initWorker, initargs=(self.cv_threads,))
+        # start every worker now, so the first jobs don't pay for the imports
+        for future in [self.executor.submit(_warmUp) for _ in range(self.jobs)]:
+            future.result()
+    
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+    
+    def reserve(self) -> bool:
+        # takes a slot before the request body is read, False if the queue is full. release frees it.
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            self.stats['rejected'] += 1
+        return False
+    
+    def release(self):
+        self.slots.release()
+    
+    def submit(self, func, *args) -> object:
+        # runs a job in a reserved slot
+        start = time.perf_counter()
+        with self.lock:
+            self.stats['active'] += 1
+        try:
+            executor = self.executor
+            try:
+                result = executor.submit(func, *args).result()
+            except BrokenProcessPool: # a worker died, the pool can't be used anymore
+                with self.lock:
+                    self.stats['errors'] += 1
+                    self._restart(executor)
+                raise
+            except (CancelledError, RuntimeError): # queued on a pool another job broke, it was replaced meanwhile
+                if executor is self.executor:
+                    raise
+                result = self.executor.submit(func, *args).result()
+            with self.lock:
+                self.stats['completed' if result[0] else 'failed'] += 1
+                self.stats['seconds'] += time.perf_counter() - start
+            return result
+        finally:
+            with self.lock:
+                self.stats['active'] -= 1
+    
+    def status(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        done = stats['completed'] + stats['failed']
+        active = stats.pop('active')
+        stats['running'] = min(active, self.jobs)
+        stats['queued'] = max(active - self.jobs, 0)
+        stats['mean_seconds'] = stats.pop('seconds') / done if done else 0.0
+        stats.update(jobs=self.jobs, queue=self.queue, uptime=time.time() - self.start_time)
+        if self.cache is not None:
+            stats['cache_size'] = self.cache.size()
+        return stats
+    
+    def params(self, items, upload=False) -> dict:
+        # raises KeyError on unknown parameters, PermissionError on file parameters without paths
+        # and ValueError on parameters of file jobs in uploads
+        params = {}
+        for key, value in items:
+            if key not in PARAMS:
+                raise KeyError(key)
+            if key in PATH_PARAMS and not self.paths:
+                raise PermissionError(key)
+            if key in FILE_PARAMS and upload:
+                raise ValueError(f'{key} needs a file job, uploads are converted as still images')
+            params[key] = str(value)
+        params['cache'] = self.cache
+        return params
+    
+    def _restart(self, broken):
+        # every job of the broken pool fails, only the first one replaces it
+        if self.executor is not broken:
+            return
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=_initWorker, initargs=(self.cv_threads,))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'RePixelator/' + __version__
+    
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self.sendJSON(200, {'status': 'ok', 'version': __version__})
+        elif path == '/stats':
+            self.sendJSON(200, self.server.app.status())
+        else:
+            self.sendJSON(404, {'error': 'not found'})
+    
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            self.sendJSON(404, {'error': 'not found'})
+            return
+        
+        app = self.server.app
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.sendJSON(400, {'error': 'invalid request'})
+            return
+        
+        # the body isn't read when it can't be converted, so the connection can't be reused
+        if length > app.max_body:
+            self.close_connection = True
+            self.sendJSON(413, {'error': f'request body over {app.max_body} bytes'})
+            return
+        if not app.reserve():
+            self.close_connection = True
+            self.sendJSON(503, {'error': 'queue full'}, {'Retry-After': '1'})
+            return
+        try:
+            self.convert(app, url, length)
+        finally:
+            app.release()
+    
+    def convert(self, app, url, length):
+        try:
+            data = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                job = json.loads(data)
+                if not isinstance(job, dict):
+                    raise ValueError('not an object')
+                if not app.paths:
+                    raise PermissionError('in_file')
+                in_file, out_file = job.pop('in_file'), job.pop('out_file')
+                params = app.params(job.items())
+                task = (_convertOne, in_file, out_file, params)
+            else:
+                query = dict(parse_qsl(url.query))
+                ext = query.pop('format', '.png')
+                params = app.params(query.items(), upload=True)
+                task = (_convertBytes, data, ext, params)
+        except KeyError as e:
+            self.sendJSON(400, {'error': f'missing or unknown parameter: {e}'})
+            return
+        except PermissionError as e:
+            self.sendJSON(403, {'error': f'file access is disabled on this address, upload the image instead: {e}'})
+            return
+        except (ValueError, AttributeError) as e:
+            self.sendJSON(400, {'error': f'invalid request: {e}' if str(e) else 'invalid request'})
+            return
+        
+        try:
+            result = app.submit(*task)
+        except (BrokenProcessPool, CancelledError, RuntimeError):
+            self.sendJSON(500, {'error': 'worker crashed'})
+            return
+        
+        if task[0] is _convertOne:
+            ok, log, report = result
+            self.sendJSON(200, {'ok': ok, 'out_file': out_file, 'log': log, 'report': report})
+        else:
+            ok, log, report, out = result
+            if not ok:
+                self.sendJSON(422, {'ok': False, 'log': log, 'report': report})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(out)))
+            self.send_header('X-RePixelator-Report', json.dumps(report))
+            self.end_headers()
+            self.wfile.write(out)
+    
+    def sendJSON(self, code, obj, headers={}):
+        data = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def _warmUp():
+    import cv2
+    from . import repixelator
+    return os.getpid()
+
+def _convertBytes(data: bytes, ext: str, params: dict) -> (bool, str, dict, bytes):
+    from .repixelator import rePixelateBytes, GridProfile
+    
+    log = io.StringIO()
+    report = {}
+    start = time.perf_counter()
+    out = b''
+    with contextlib.redirect_stdout(log):
+        try:
+            profile = GridProfile.load(params['profile']) if 'profile' in params else None
+            mul = params.get('mul', '4')
+            ok, out = rePixelateBytes(data, ext, mul if mul == 'auto' else int(mul), float(params.get('nr_sigma', 0.0)),
+                                      float(params.get('edge_threshold', 1.0)), params.get('detector', 'projection'),
+                                      params.get('reduction', 'upscale'), report, int(params.get('band', 0)), params.get('cache'), profile,
+                                      workspace=_workspace)
+            out = out.tobytes() # sent back to the server process
+        except Exception as e:
+            print('Unknown error:', e)
+            ok = False
+    report['seconds'] = time.perf_counter() - start
+    return ok, log.getvalue(), report, out
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='repixelator serve', description='Keep warm workers and convert the jobs sent by repixelator client.')
+    parser.add_argument('--host', default='127.0.0.1', help='listen address (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='listen port (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes (default: CPU count)')
+    parser.add_argument('--queue', type=int, help='jobs waiting for a worker before new ones are rejected (default: 4 per worker)')
+    parser.add_argument('--cv-threads', type=int, default=1, help='OpenCV threads per worker (default: %(default)s)')
+    parser.add_argument('--allow-paths', action='store_true', help='accept file jobs and profile files on addresses other than loopback')
+    parser.add_argument('--max-upload', type=int, default=MAX_BODY >> 20, help='largest request body in MB (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    parser.add_argument('--cache', action='store_true', help='reuse detected grids from the on-disk cache')
+    parser.add_argument('--no-cache', action='store_true', help='disable the cache')
+    parser.add_argument('--cache-dir', help='cache directory (default: REPIXELATOR_CACHE or the user cache directory)')
+    parser.add_argument('--cache-size', type=int, default=100000, help='maximum number of cached grids (default: %(default)s)')
+    return parser
+
+def main(args = sys.argv[1:]) -> int:
+    args = parser().parse_args(args)
+    args.clear_cache = False
+    print('RePixelator', __version__, 'server')
+    
+    app = ConversionServer(args.jobs, args.queue, args.cv_threads, gridCache(args), max_body=args.max_upload << 20)
+    try:
+        httpd = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    except OSError as e:
+        print('Can\'t listen on', f'{args.host}:{args.port}:', e)
+        return 2
+    # file jobs read and write any file the server can reach, other hosts only get the upload mode
+    app.paths = args.allow_paths or ipaddress.ip_address(httpd.server_address[0]).is_loopback
+    if not app.paths:
+        print(f'{args.host} is not a loopback address, file jobs and profile files are disabled (see --allow-paths)')
+    httpd.app = app
+    httpd.verbose = args.verbose
+    httpd.daemon_threads = True
+    
+    app.start()
+    print(f'Listening on http://{args.host}:{httpd.server_port} with {app.jobs} workers, queue {app.queue}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('\nStopping')
+    finally:
+        httpd.server_close()
+        app.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
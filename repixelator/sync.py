@@ -0,0 +1,285 @@
+# Incremental directory sync for RePixelator
+# Converts the new and changed files of an input directory into a mirrored output directory and removes the outputs of deleted inputs.
+# A manifest in the output directory records the size, mtime, content hash, parameters, outputs and result of every input,
+# so an unchanged directory only costs one stat per file.
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+from .repixelator import GridProfile, __version__
+from .batch import FILE_EXTS, convertFiles, printSummary, fileParams, gridCache, addParamArguments, addCacheArguments
+
+
+MANIFEST_NAME = '.repixelator-sync.json'
+MANIFEST_VERSION = 1
+HASH_CHUNK = 1 << 20
+SAVE_INTERVAL = 10 # seconds between manifest saves while converting
+RUN_PARAMS = ('workers', 'queue_depth') # only change how the files are converted, the outputs are the same
+
+
+class Manifest():
+    # input path relative to the input directory -> {size, mtime, hash, params, output, outputs, ok}
+    # output is the output file name and outputs the written files (the frames of animations), relative to the output directory
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.entries = {}
+        self.changed = False
+        self.saved = time.monotonic()
+    
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data['files']
+        except (OSError, ValueError, KeyError): # first run or unreadable, everything is converted again
+            self.entries = {}
+    
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.path.with_name(f'{self.path.name}.{uuid.uuid4().hex}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.entries}, f, separators=(',', ':'))
+        os.replace(tmp, self.path) # atomic, an interrupted save keeps the old manifest
+        self.changed = False
+        self.saved = time.monotonic()
+    
+    def set(self, rel: str, entry: dict):
+        self.entries[rel] = entry
+        self.changed = True
+    
+    def remove(self, rel: str):
+        del self.entries[rel]
+        self.changed = True
+
+
+def scanFiles(in_dir: str, skip_dir=None) -> dict:
+    # relative path -> (size, mtime in ns) of the input files, skip_dir is left out when it's inside in_dir
+    # plain string operations, pathlib and relpath cost more than the stat calls on large trees
+    skip = os.path.realpath(skip_dir) if skip_dir else None
+    files = {}
+    stack = [(in_dir, '')]
+    while stack:
+        top, prefix = stack.pop()
+        try:
+            entries = list(os.scandir(top))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if os.path.realpath(entry.path) != skip:
+                        stack.append((entry.path, prefix + entry.name + '/'))
+                elif os.path.splitext(entry.name)[1].lower() in FILE_EXTS:
+                    stat = entry.stat()
+                    files[prefix + entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError: # removed while scanning
+                pass
+    return files
+
+def fileHash(file: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def paramsKey(params: dict, template: str, profile=None) -> str:
+    # changes when anything that affects the outputs changes
+    key = {name: value for name, value in params.items() if name not in RUN_PARAMS}
+    key.update(template=template, profile=fileHash(profile) if profile else None)
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+def outputRel(rel: str, template: str) -> str:
+    parent, _, name = rel.rpartition('/')
+    return parent + '/' * bool(parent) + template % os.path.splitext(name)[0]
+
+def syncOnce(in_dir: str, out_dir: str, manifest: Manifest, params: dict, key: str, template='%s.png', jobs=None, cv_threads=None,
+             verbose=True, json_out=None, retry_failed=False, settle=0.0) -> dict:
+    # settle: seconds since the last modification before a file is converted, for files that are still being written
+    scanned = scanFiles(in_dir, out_dir)
+    now = time.time_ns()
+    out_base = os.path.join(out_dir, '')
+    
+    todo = []
+    stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0, 'retried': 0, 'missing': 0, 'pending': 0}
+    for rel, (size, mtime) in scanned.items():
+        if settle and now - mtime < settle * 1e9:
+            stats['pending'] += 1
+            continue
+        
+        entry = manifest.entries.get(rel)
+        out_rel = outputRel(rel, template)
+        if entry is None:
+            stats['new'] += 1
+            todo.append(rel)
+            continue
+        
+        same = entry['params'] == key and entry['output'] == out_rel
+        if same and (entry['size'], entry['mtime']) != (size, mtime) and entry['size'] == size:
+            # touched but maybe not modified, the hash decides
+            try:
+                if fileHash(os.path.join(in_dir, rel)) == entry['hash']:
+                    manifest.set(rel, dict(entry, mtime=mtime))
+            except OSError:
+                pass
+            entry = manifest.entries[rel]
+        
+        if not same or (entry['size'], entry['mtime']) != (size, mtime):
+            stats['changed'] += 1
+            todo.append(rel)
+        elif not entry['ok'] and retry_failed:
+            stats['retried'] += 1
+            todo.append(rel)
+        elif entry['ok'] and not all(os.path.exists(out_base + out) for out in entry['outputs']):
+            stats['missing'] += 1 # output deleted by hand
+            todo.append(rel)
+        else:
+            stats['unchanged'] += 1
+    
+    # outputs of removed inputs
+    for rel in [rel for rel in manifest.entries if rel not in scanned]:
+        _removeOutputs(out_dir, manifest.entries[rel]['outputs'])
+        manifest.remove(rel)
+        stats['removed'] += 1
+    
+    summary = None
+    if todo:
+        files, outputs, hashes = [], [], []
+        for rel in todo:
+            if rel in manifest.entries: # the new outputs may have other names or fewer frames
+                _removeOutputs(out_dir, manifest.entries[rel]['outputs'])
+            try:
+                hashes.append(fileHash(os.path.join(in_dir, rel)))
+            except OSError: # removed meanwhile
+                continue
+            out_file = os.path.join(out_dir, outputRel(rel, template))
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            files.append(os.path.join(in_dir, rel))
+            outputs.append(out_file)
+        todo = [os.path.relpath(file, in_dir).replace(os.sep, '/') for file in files]
+        
+        def done(i, ok, report):
+            size, mtime = scanned[todo[i]]
+            manifest.set(todo[i], {'size': size, 'mtime': mtime, 'hash': hashes[i], 'params': key, 'output': outputRel(todo[i], template),
+                                   'outputs': _outputs(out_dir, outputs[i]) if ok else [], 'ok': ok})
+            if time.monotonic() - manifest.saved > SAVE_INTERVAL:
+                manifest.save()
+        
+        summary = convertFiles(files, params=params, jobs=jobs, cv_threads=cv_threads, verbose=verbose, json_out=json_out, outputs=outputs, on_done=done)
+    
+    manifest.save()
+    return {'sync': stats, 'summary': summary}
+
+def _outputs(out_dir: str, out_file: str) -> list:
+    # the output file, or the frame files of an animation
+    if os.path.exists(out_file):
+        files = [out_file]
+    else:
+        path = Path(out_file)
+        files = sorted(glob.glob(glob.escape(str(path.parent / path.stem)) + '_frame*' + path.suffix))
+    return [os.path.relpath(file, out_dir).replace(os.sep, '/') for file in files]
+
+def _removeOutputs(out_dir: str, outputs: list):
+    for out in outputs:
+        try:
+            os.remove(os.path.join(out_dir, out))
+        except OSError:
+            pass
+
+def printSync(result: dict):
+    stats = result['sync']
+    extra = ''.join(f', {stats[key]} {key}' for key in ('retried', 'missing', 'pending') if stats[key])
+    print(f"Sync: {stats['new']} new, {stats['changed']} changed, {stats['unchanged']} unchanged, {stats['removed']} removed" + extra)
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='repixelator sync', description='Convert only the new and changed files of a directory.')
+    parser.add_argument('in_dir', help='input directory, searched recursively')
+    parser.add_argument('out_dir', help='output directory, mirrors the input directory')
+    parser.add_argument('-o', '--output', default='%s.png', help='output file name, %%s is the input file name (default: %(default)s)')
+    parser.add_argument('--manifest', help=f'manifest file (default: {MANIFEST_NAME} in the output directory)')
+    parser.add_argument('-w', '--watch', action='store_true', help='keep watching the input directory')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between scans when watching (default: %(default)s)')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds a file must be unmodified before it is converted when watching (default: %(default)s)')
+    parser.add_argument('--retry-failed', action='store_true', help='convert the files that failed before again')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes (default: CPU count)')
+    parser.add_argument('--cv-threads', type=int, help='OpenCV threads per worker (default: 1 with several workers)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    parser.add_argument('--json', action='store_true', help='print the report of each file and the sync summary as JSON lines')
+    addParamArguments(parser)
+    addCacheArguments(parser)
+    return parser
+
+def main(args = sys.argv[1:]) -> int:
+    args = parser().parse_args(args)
+    if args.json: # stdout only carries the JSON lines
+        json_out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            return _run(args, json_out)
+    return _run(args)
+
+def _run(args, json_out=None) -> int:
+    print('RePixelator', __version__, 'sync')
+    
+    try:
+        args.output % ''
+    except:
+        print('Invalid output file name')
+        return 2
+    if not os.path.isdir(args.in_dir):
+        print('No input directory')
+        return 2
+    os.makedirs(args.out_dir, exist_ok=True)
+    
+    params = fileParams(args)
+    try:
+        key = paramsKey(params, args.output, args.profile)
+        if args.profile:
+            params['profile'] = GridProfile.load(args.profile)
+    except:
+        print('Profile read error.')
+        return 2
+    args.clear_cache = False
+    params['cache'] = gridCache(args)
+    
+    manifest = Manifest(args.manifest or os.path.join(args.out_dir, MANIFEST_NAME))
+    manifest.load()
+    
+    ret = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            result = syncOnce(args.in_dir, args.out_dir, manifest, params, key, args.output, args.jobs, args.cv_threads,
+                              not args.quiet, json_out, args.retry_failed, args.settle if args.watch else 0.0)
+            result['seconds'] = time.perf_counter() - start
+            args.retry_failed = False # once per run, failed files would be retried on every scan
+            
+            stats = result['sync']
+            if not args.watch or result['summary'] or stats['removed']: # watching stays quiet while nothing happens
+                if result['summary']:
+                    printSummary(result['summary'])
+                printSync(result)
+                if json_out is not None:
+                    print(json.dumps(result), file=json_out, flush=True)
+            ret = 1 if result['summary'] and result['summary']['failed'] else 0
+            
+            if not args.watch:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print('\nStopping')
+    finally:
+        manifest.save()
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
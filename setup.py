@@ -1,9 +1,9 @@
 import setuptools
 
 
-with open('repixelator/repixelator.py', encoding='utf-8') as f:
+with open('repixelator/_version.py', encoding='utf-8') as f:
     for line in f.readlines():
-        if '__version__' in line:
+        if line.startswith('__version__'):
             __version__ = line.split("'")[1].strip()
             break
 
@@ -38,5 +38,5 @@ setuptools.setup(
         'opencv-python',
         'numpy',
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.9',
 )
\ No newline at end of file
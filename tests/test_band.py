@@ -0,0 +1,30 @@
+# Banded reductions must give the same output as reducing the whole image at once
+
+import numpy as np
+import pytest
+
+from repixelator.repixelator import _reduceGrid
+
+
+GRIDS = [
+    # conv_x, conv_y, offset_x, offset_y, dir_x, dir_y
+    (40, 30, 0.0, 0.0, 0, 0),
+    (37, 29, 1.3, 2.6, 1, 1),
+    (41, 33, 0.7, 1.9, -1, 1),
+    (23, 47, 2.2, 0.4, 1, -1),
+]
+
+@pytest.mark.parametrize('reduction', ['mean', 'center', 'median', 'mode'])
+@pytest.mark.parametrize('grid', GRIDS)
+@pytest.mark.parametrize('band', [1, 7, 16, 50])
+def test_band_matches_unbanded(reduction, grid, band):
+    # noisy cells of uneven heights, so the sample count of a band could differ from the whole image
+    rng = np.random.default_rng(sum(grid[:2]) + band)
+    img = rng.integers(0, 4, (157, 211, 3), dtype='uint8') * 60
+    assert np.array_equal(_reduceGrid(img, reduction, *grid, band), _reduceGrid(img, reduction, *grid))
+
+@pytest.mark.parametrize('reduction', ['median', 'mode'])
+def test_band_matches_unbanded_gray(reduction):
+    rng = np.random.default_rng(1)
+    img = rng.integers(0, 256, (120, 90), dtype='uint8')
+    assert np.array_equal(_reduceGrid(img, reduction, 31, 26, 0.5, 1.5, 1, 1, 9), _reduceGrid(img, reduction, 31, 26, 0.5, 1.5, 1, 1))